@@ -0,0 +1,92 @@
+# Microbenchmark: apply_font (str.translate tables) vs the original per-character loop.
+# Asserts identical output for every style, then prints timings per text size.
+# Usage: python bench_font.py   (imports bot.py; no network or DB access happens at import)
+
+import os
+import random
+import string
+import sys
+import timeit
+from typing import Optional
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+import bot  # noqa: E402
+
+
+# ---------------------------- REFERENCE (original implementation) ----------------------------
+
+def _math_alpha_ref(ch: str, base_upper: int, base_lower: int, base_digit: Optional[int] = None) -> str:
+    o = ord(ch)
+    if 65 <= o <= 90:  # A-Z
+        return chr(base_upper + (o - 65))
+    if 97 <= o <= 122:  # a-z
+        return chr(base_lower + (o - 97))
+    if base_digit is not None and 48 <= o <= 57:  # 0-9
+        return chr(base_digit + (o - 48))
+    return ch
+
+
+def apply_font_ref(text: str, style: str) -> str:
+    st = (style or "normal").strip().lower()
+    if st not in bot.FONT_STYLES:
+        st = "normal"
+
+    if st == "normal":
+        return text
+
+    if st == "smallcaps":
+        out = []
+        for ch in text:
+            low = ch.lower()
+            out.append(bot._SMALLCAPS_MAP.get(low, ch))
+        return "".join(out)
+
+    if st == "bold":
+        return "".join(_math_alpha_ref(ch, 0x1D400, 0x1D41A, 0x1D7CE) for ch in text)
+
+    if st == "italic":
+        return "".join(_math_alpha_ref(ch, 0x1D434, 0x1D44E, None) for ch in text)
+
+    if st == "mono":
+        return "".join(_math_alpha_ref(ch, 0x1D670, 0x1D68A, 0x1D7F6) for ch in text)
+
+    return text
+
+
+# ---------------------------- BENCH ----------------------------
+
+SIZES = (10, 100, 1000, 4000)
+RUNS = 300
+
+
+def check_all_code_points() -> None:
+    full = "".join(chr(i) for i in range(sys.maxunicode + 1) if not 0xD800 <= i < 0xE000)
+    for st in sorted(bot.FONT_STYLES):
+        assert bot.apply_font(full, st) == apply_font_ref(full, st), f"output differs for style {st}"
+
+
+def main() -> None:
+    check_all_code_points()
+    print("Output identical for every style over all code points.\n")
+
+    rng = random.Random(0)
+    alphabet = string.printable + "ÄéßİK😀✅"
+    print(f"{'size':>5} {'style':<10} {'old us':>9} {'new us':>9} {'speedup':>8}")
+    for n in SIZES:
+        text = "".join(rng.choice(alphabet) for _ in range(n))
+        for st in sorted(bot.FONT_STYLES):
+            assert bot.apply_font(text, st) == apply_font_ref(text, st)
+            old = timeit.timeit(lambda: apply_font_ref(text, st), number=RUNS) / RUNS
+            new = timeit.timeit(lambda: bot.apply_font(text, st), number=RUNS) / RUNS
+            print(f"{n:>5} {st:<10} {old * 1e6:>9.1f} {new * 1e6:>9.1f} {old / max(new, 1e-9):>7.1f}x")
+
+    # Cached path: constant UI text rendered in the current style
+    bot.FONT_STYLE = "smallcaps"
+    bot._font_cache.clear()
+    cached = timeit.timeit(lambda: bot.apply_font("Admin only.", cache=True), number=100_000) / 100_000
+    print(f"\ncached 'Admin only.' ({bot.FONT_STYLE}): {cached * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
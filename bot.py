@@ -1,18 +1,31 @@
 import asyncio
+import heapq
 import json
 import logging
+import math
+import multiprocessing
 import os
 import random
+import re
+import signal
 import string
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
 
-import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
+import psycopg
+from psycopg_pool import AsyncConnectionPool
 
 from telegram import (
     BotCommand,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
     Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
@@ -21,12 +34,15 @@ from telegram import (
 from telegram.ext import (
     Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.request import HTTPXRequest
 
 # ---------------------------- CONFIG ----------------------------
@@ -52,6 +68,41 @@ AUTO_DELETE_SECONDS = int(os.getenv("AUTO_DELETE_SECONDS", str(3 * 60 * 60)).str
 
 DAILY_LIMIT_TZ = os.getenv("DAILY_LIMIT_TZ", "Asia/Kolkata").strip()
 
+# Force-join membership cache: confirmed members are trusted for longer than "left"/errors
+FORCE_JOIN_MEMBER_TTL = int(os.getenv("FORCE_JOIN_MEMBER_TTL", "600").strip())
+FORCE_JOIN_NEGATIVE_TTL = int(os.getenv("FORCE_JOIN_NEGATIVE_TTL", "30").strip())
+FORCE_JOIN_CACHE_MAX = int(os.getenv("FORCE_JOIN_CACHE_MAX", "50000").strip())
+
+# All channel checks run concurrently under one deadline (seconds). Channels that don't answer
+# in time are treated per policy: "closed" = not joined (safe default), "open" = assume joined.
+FORCE_JOIN_DEADLINE = float(os.getenv("FORCE_JOIN_DEADLINE", "5").strip())
+FORCE_JOIN_TIMEOUT_POLICY = os.getenv("FORCE_JOIN_TIMEOUT_POLICY", "closed").strip().lower()
+
+# Update delivery: "polling" (default) or "webhook".
+# Webhook mode: Telegram POSTs updates to WEBHOOK_URL; the built-in server listens on
+# WEBHOOK_LISTEN:WEBHOOK_PORT at /WEBHOOK_PATH and rejects requests without WEBHOOK_SECRET_TOKEN.
+# Local test: POST a recorded update JSON to http://127.0.0.1:<port>/<path> with header
+# "X-Telegram-Bot-Api-Secret-Token: <secret>".
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")).strip())
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "").strip()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40").strip())
+# Same set in both modes: only what the handlers use (commands/messages and button callbacks)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY]
+# Kept off by default: updates queued while the bot restarts are still handled afterwards.
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0").strip() == "1"
+
+# "all": one process receives and handles updates. To scale, run one "front" (polling or the
+# webhook) plus workers: the front shards updates by user id into update_inbox and each shard
+# is consumed by exactly one worker (see UPDATE SHARDING). BOT_WORKERS spawns that many local
+# workers from the front; more nodes join with BOT_ROLE=worker. Don't put several "all"
+# processes behind a load balancer: their in-memory user_data would diverge.
+BOT_ROLE = os.getenv("BOT_ROLE", "all").strip().lower()
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0").strip())
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is missing. Set BOT_TOKEN in Railway/Hosting env variables.")
 if not DATABASE_URL:
@@ -67,167 +118,663 @@ logger = logging.getLogger("file_store_bot")
 
 # ---------------------------- DB (POOL) ----------------------------
 
-_db_pool: Optional[ThreadedConnectionPool] = None
+# psycopg 3 async pool: queries run on the event loop without blocking other updates.
+_db_pool: Optional[AsyncConnectionPool] = None
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1").strip())
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10").strip())
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300").strip())
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800").strip())
 
 
-def init_db_pool() -> ThreadedConnectionPool:
+async def init_db_pool() -> AsyncConnectionPool:
     global _db_pool
     if _db_pool is not None:
         return _db_pool
 
-    _db_pool = ThreadedConnectionPool(
-        minconn=1,
-        maxconn=10,
-        dsn=DATABASE_URL,
-        sslmode="require",
+    pool = AsyncConnectionPool(
+        conninfo=DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        # prepare_threshold=None keeps us compatible with the Supabase transaction pooler.
+        # Autocommit: every helper is one statement, so no BEGIN/COMMIT round trips.
+        kwargs={"sslmode": "require", "prepare_threshold": None, "autocommit": True},
+        # No per-checkout ping: broken connections are discarded by the pool on error, and
+        # idle/old ones are recycled before the server or a proxy drops them.
+        max_idle=DB_POOL_MAX_IDLE,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        open=False,
     )
+    await pool.open()
+    _db_pool = pool
     return _db_pool
 
 
-def _db_exec(
+async def close_db_pool() -> None:
+    global _db_pool
+    if _db_pool is None:
+        return
+    try:
+        await _db_pool.close()
+    finally:
+        _db_pool = None
+
+
+async def _db_exec(
     query: str,
     params: Optional[Tuple[Any, ...]] = None,
     fetchone: bool = False,
     fetchall: bool = False,
-    commit: bool = False,
 ) -> Any:
-    pool = init_db_pool()
-    conn = None
+    pool = await init_db_pool()
     try:
-        conn = pool.getconn()
-        with conn.cursor() as cur:
-            cur.execute(query, params)
-            result = None
-            if fetchone:
-                result = cur.fetchone()
-            elif fetchall:
-                result = cur.fetchall()
-            if commit:
-                conn.commit()
-            return result
-    except psycopg2.OperationalError as e:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                result = None
+                if fetchone:
+                    result = await cur.fetchone()
+                elif fetchall:
+                    result = await cur.fetchall()
+                return result
+    except psycopg.OperationalError as e:
+        # The pool rolls back and discards broken connections on its own.
         logger.error("DB OperationalError: %s", e)
-        try:
-            if conn:
-                conn.rollback()
-        except Exception:
-            pass
-        # Recreate pool once (idle disconnects)
-        try:
-            global _db_pool
-            if _db_pool:
-                _db_pool.closeall()
-            _db_pool = None
-            init_db_pool()
-        except Exception as e2:
-            logger.error("DB pool recreate failed: %s", e2)
-        raise
-    except Exception:
-        if conn:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
         raise
-    finally:
-        if conn:
-            pool.putconn(conn)
 
 
-def ensure_schema() -> None:
-    _db_exec(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username TEXT,
-            active INTEGER DEFAULT 1,
-            premium INTEGER DEFAULT 0,
-            banned INTEGER DEFAULT 0
-        )
-        """,
-        commit=True,
-    )
-    _db_exec(
-        """
-        CREATE TABLE IF NOT EXISTS media_files (
-            media_id TEXT PRIMARY KEY,
-            files TEXT
-        )
-        """,
-        commit=True,
-    )
-    _db_exec(
-        """
-        CREATE TABLE IF NOT EXISTS force_join_channels (
-            id SERIAL PRIMARY KEY,
-            channel_link TEXT NOT NULL,
-            chat_id TEXT NOT NULL,
-            button_name TEXT NOT NULL,
-            enabled INTEGER DEFAULT 1,
-            UNIQUE(channel_link, chat_id, button_name)
-        )
-        """,
-        commit=True,
-    )
-    _db_exec(
-        """
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        """,
-        commit=True,
-    )
-    _db_exec(
+# ---------------------------- CACHE INVALIDATION (LISTEN/NOTIFY) ----------------------------
+
+# Every instance sharing the DB LISTENs on one channel. Payload format: "<topic>:<detail>".
+CACHE_NOTIFY_CHANNEL = "bot_cache"
+
+_notify_handlers: Dict[str, Callable[[str], Awaitable[None]]] = {}
+_notify_resync: List[Callable[[], Awaitable[None]]] = []
+_notify_task: Optional[asyncio.Task] = None
+
+
+def register_cache_topic(
+    topic: str,
+    on_notify: Callable[[str], Awaitable[None]],
+    on_resync: Callable[[], Awaitable[None]],
+) -> None:
+    # on_notify(detail) handles one event; on_resync() reloads everything after a reconnect.
+    _notify_handlers[topic] = on_notify
+    _notify_resync.append(on_resync)
+
+
+async def _dispatch_notify(payload: str) -> None:
+    topic, _, detail = (payload or "").partition(":")
+    handler = _notify_handlers.get(topic)
+    if not handler:
+        return
+    try:
+        await handler(detail)
+    except Exception as e:
+        logger.warning("Cache notify handler failed (%s): %s", payload, e)
+
+
+async def _cache_listener_loop() -> None:
+    # Dedicated autocommit connection (LISTEN must not sit in a pooled connection).
+    first = True
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                DATABASE_URL, autocommit=True, sslmode="require", prepare_threshold=None
+            ) as conn:
+                await conn.execute(f"LISTEN {CACHE_NOTIFY_CHANNEL}")
+                if not first:
+                    # Notifications may have been missed while disconnected
+                    for resync in _notify_resync:
+                        await resync()
+                first = False
+                async for n in conn.notifies():
+                    await _dispatch_notify(n.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            first = False
+            logger.warning("Cache listener disconnected: %s (retrying in 5s)", e)
+            await asyncio.sleep(5)
+
+
+def start_cache_listener() -> None:
+    global _notify_task
+    if _notify_task is None or _notify_task.done():
+        _notify_task = asyncio.create_task(_cache_listener_loop())
+
+
+async def stop_cache_listener() -> None:
+    global _notify_task
+    if _notify_task is None:
+        return
+    _notify_task.cancel()
+    try:
+        await _notify_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    _notify_task = None
+
+
+# ---------------------------- SCHEMA MIGRATIONS ----------------------------
+
+# Ordered, append-only. Each step: (version, description, statements).
+# Steps containing CREATE INDEX CONCURRENTLY run statement-by-statement in autocommit;
+# everything else runs in a single transaction together with its schema_version row.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (
+        1,
+        "base tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                active INTEGER DEFAULT 1,
+                premium INTEGER DEFAULT 0,
+                banned INTEGER DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS media_files (
+                media_id TEXT PRIMARY KEY,
+                files TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS force_join_channels (
+                id SERIAL PRIMARY KEY,
+                channel_link TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                button_name TEXT NOT NULL,
+                enabled INTEGER DEFAULT 1,
+                UNIQUE(channel_link, chat_id, button_name)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS downloads (
+                id SERIAL PRIMARY KEY,
+                media_id TEXT NOT NULL,
+                user_id BIGINT NOT NULL,
+                ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS admins (
+                user_id BIGINT PRIMARY KEY,
+                added_by BIGINT,
+                ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        "pending_deletions",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                due_at TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )
+            """,
+        ],
+    ),
+    (
+        3,
+        "broadcast_jobs",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                created_by BIGINT,
+                payload TEXT NOT NULL,
+                target TEXT NOT NULL DEFAULT 'all',
+                status TEXT NOT NULL DEFAULT 'running',
+                cursor_user_id BIGINT NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                invalid INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                progress_chat_id BIGINT,
+                progress_message_id BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+        ],
+    ),
+    (
+        4,
+        "user_daily_usage",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS user_daily_usage (
+                user_id BIGINT NOT NULL,
+                day DATE NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            )
+            """,
+            # Seed recent days so today's limits (and 7-day activity) are right on first deploy
+            """
+            INSERT INTO user_daily_usage (user_id, day, count)
+            SELECT user_id, timezone(current_setting('bot.daily_tz'), ts::timestamptz)::date, COUNT(*)
+            FROM downloads
+            WHERE ts::timestamptz > now() - interval '31 days'
+            GROUP BY 1, 2
+            ON CONFLICT (user_id, day) DO NOTHING
+            """,
+        ],
+    ),
+    (
+        5,
+        "indexes for hot lookups",
+        [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_downloads_user_id ON downloads (user_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_downloads_media_id ON downloads (media_id)",
+            # Broadcast audiences (keyset over user_id)
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_audience_all ON users (user_id) WHERE banned = 0",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_audience_premium ON users (user_id) "
+            "WHERE banned = 0 AND premium = 1",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_force_join_enabled ON force_join_channels (id) "
+            "WHERE enabled = 1",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_broadcast_jobs_running ON broadcast_jobs (id) "
+            "WHERE status = 'running'",
+        ],
+    ),
+    (
+        6,
+        "media_items (normalized bundles) + backfill from media_files.files",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS media_items (
+                media_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                file_unique_id TEXT,
+                caption TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (media_id, position)
+            )
+            """,
+            # Per-row exception handling: one malformed legacy JSON blob must not abort the migration
+            """
+            DO $$
+            DECLARE r RECORD;
+            BEGIN
+                FOR r IN SELECT media_id, files FROM media_files WHERE files IS NOT NULL LOOP
+                    BEGIN
+                        INSERT INTO media_items (media_id, position, type, file_id, file_unique_id, caption)
+                        SELECT r.media_id, (e.ord - 1)::int, e.item->>'type', e.item->>'file_id',
+                               e.item->>'file_unique_id', COALESCE(e.item->>'caption', '')
+                        FROM jsonb_array_elements(r.files::jsonb) WITH ORDINALITY AS e(item, ord)
+                        WHERE e.item->>'type' IS NOT NULL AND e.item->>'file_id' IS NOT NULL
+                        ON CONFLICT (media_id, position) DO NOTHING;
+                    EXCEPTION WHEN others THEN
+                        RAISE NOTICE 'media_items backfill skipped %: %', r.media_id, SQLERRM;
+                    END;
+                END LOOP;
+            END $$
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_media_items_type ON media_items (type)",
+        ],
+    ),
+    (
+        7,
+        "bot_counters maintained by triggers",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS bot_counters (
+                id SMALLINT PRIMARY KEY CHECK (id = 1),
+                users BIGINT NOT NULL DEFAULT 0,
+                banned BIGINT NOT NULL DEFAULT 0,
+                premium BIGINT NOT NULL DEFAULT 0,
+                downloads BIGINT NOT NULL DEFAULT 0,
+                reconciled_at TIMESTAMPTZ
+            )
+            """,
+            """
+            CREATE OR REPLACE FUNCTION bot_counters_users() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE bot_counters SET
+                        users = users + 1,
+                        banned = banned + (COALESCE(NEW.banned, 0) = 1)::int,
+                        premium = premium + (COALESCE(NEW.premium, 0) = 1)::int
+                    WHERE id = 1;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    UPDATE bot_counters SET
+                        banned = banned + (COALESCE(NEW.banned, 0) = 1)::int - (COALESCE(OLD.banned, 0) = 1)::int,
+                        premium = premium + (COALESCE(NEW.premium, 0) = 1)::int - (COALESCE(OLD.premium, 0) = 1)::int
+                    WHERE id = 1;
+                ELSIF TG_OP = 'DELETE' THEN
+                    UPDATE bot_counters SET
+                        users = users - 1,
+                        banned = banned - (COALESCE(OLD.banned, 0) = 1)::int,
+                        premium = premium - (COALESCE(OLD.premium, 0) = 1)::int
+                    WHERE id = 1;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION bot_counters_downloads() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE bot_counters SET downloads = downloads + (SELECT COUNT(*) FROM new_rows) WHERE id = 1;
+                ELSE
+                    UPDATE bot_counters SET downloads = downloads - (SELECT COUNT(*) FROM old_rows) WHERE id = 1;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS trg_bot_counters_users ON users",
+            """
+            CREATE TRIGGER trg_bot_counters_users
+            AFTER INSERT OR DELETE OR UPDATE OF banned, premium ON users
+            FOR EACH ROW EXECUTE FUNCTION bot_counters_users()
+            """,
+            # Statement-level: one counter update per (bulk) insert, not per row
+            "DROP TRIGGER IF EXISTS trg_bot_counters_downloads_ins ON downloads",
+            """
+            CREATE TRIGGER trg_bot_counters_downloads_ins
+            AFTER INSERT ON downloads REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bot_counters_downloads()
+            """,
+            "DROP TRIGGER IF EXISTS trg_bot_counters_downloads_del ON downloads",
+            """
+            CREATE TRIGGER trg_bot_counters_downloads_del
+            AFTER DELETE ON downloads REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bot_counters_downloads()
+            """,
+            """
+            INSERT INTO bot_counters (id, users, banned, premium, downloads, reconciled_at)
+            SELECT 1,
+                   (SELECT COUNT(*) FROM users),
+                   (SELECT COUNT(*) FROM users WHERE banned = 1),
+                   (SELECT COUNT(*) FROM users WHERE premium = 1),
+                   (SELECT COUNT(*) FROM downloads),
+                   now()
+            ON CONFLICT (id) DO NOTHING
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_user_daily_usage_day ON user_daily_usage (day)",
+        ],
+    ),
+    (
+        8,
+        "media_stats / media_daily_stats aggregates with HyperLogLog unique users",
+        [
+            # HLL with 2^10 registers (~3% error): register = top 10 bits of a 64-bit hash,
+            # value = position of the first 1-bit in the remaining 54 bits.
+            """
+            CREATE OR REPLACE FUNCTION hll_registers(uids BIGINT[]) RETURNS SMALLINT[]
+            LANGUAGE sql IMMUTABLE AS $$
+                SELECT array_agg(COALESCE(r.rho, 0)::smallint ORDER BY g.i)
+                FROM generate_series(0, 1023) AS g(i)
+                LEFT JOIN (
+                    SELECT (h >> 54) & 1023 AS idx,
+                           MAX(55 - length(ltrim((h & 18014398509481983)::bit(54)::text, '0'))) AS rho
+                    FROM (SELECT hashtextextended(u::text, 0) AS h FROM unnest(uids) AS u) x
+                    GROUP BY 1
+                ) r ON r.idx = g.i
+            $$
+            """,
+            """
+            CREATE OR REPLACE FUNCTION hll_merge(a SMALLINT[], b SMALLINT[]) RETURNS SMALLINT[]
+            LANGUAGE sql IMMUTABLE AS $$
+                SELECT array_agg(GREATEST(COALESCE(x, 0), COALESCE(y, 0))::smallint ORDER BY i)
+                FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i)
+            $$
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS media_stats (
+                media_id TEXT PRIMARY KEY,
+                total BIGINT NOT NULL DEFAULT 0,
+                last_download_at TIMESTAMPTZ,
+                registers SMALLINT[] NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS media_daily_stats (
+                media_id TEXT NOT NULL,
+                day DATE NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (media_id, day)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_media_stats_total ON media_stats (total DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_media_daily_stats_day ON media_daily_stats (day)",
+            """
+            INSERT INTO media_stats (media_id, total, last_download_at, registers)
+            SELECT media_id, COUNT(*), MAX(ts::timestamptz), hll_registers(array_agg(DISTINCT user_id))
+            FROM downloads GROUP BY media_id
+            ON CONFLICT (media_id) DO NOTHING
+            """,
+            """
+            INSERT INTO media_daily_stats (media_id, day, count)
+            SELECT media_id, timezone(current_setting('bot.daily_tz'), ts::timestamptz)::date, COUNT(*)
+            FROM downloads GROUP BY 1, 2
+            ON CONFLICT (media_id, day) DO NOTHING
+            """,
+        ],
+    ),
+    (
+        9,
+        "pending_deletions due index",
+        [
+            # Worker sweeps overdue rows it did not schedule itself
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pending_deletions_due ON pending_deletions (due_at)",
+        ],
+    ),
+    (
+        10,
+        "drop stats of deleted media",
+        [
+            "DELETE FROM media_stats s WHERE NOT EXISTS (SELECT 1 FROM media_files f WHERE f.media_id = s.media_id)",
+            "DELETE FROM media_daily_stats s "
+            "WHERE NOT EXISTS (SELECT 1 FROM media_files f WHERE f.media_id = s.media_id)",
+        ],
+    ),
+    (
+        11,
+        "update_inbox",
+        [
+            # Front writes received updates here; the worker holding a shard's lock consumes them in id order
+            """
+            CREATE TABLE IF NOT EXISTS update_inbox (
+                id BIGSERIAL PRIMARY KEY,
+                shard INTEGER NOT NULL,
+                payload JSONB NOT NULL,
+                received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_update_inbox_shard ON update_inbox (shard, id)",
+        ],
+    ),
+]
+
+SCHEMA_MIGRATION_LOCK = 7_431_001  # pg_advisory_lock key: one migrator at a time
+
+_CONCURRENT_INDEX_RE = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+
+async def get_schema_version() -> int:
+    row = await _db_exec(
         """
-        CREATE TABLE IF NOT EXISTS downloads (
-            id SERIAL PRIMARY KEY,
-            media_id TEXT NOT NULL,
-            user_id BIGINT NOT NULL,
-            ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        SELECT CASE WHEN to_regclass('schema_version') IS NULL THEN -1
+                    ELSE (SELECT COALESCE(MAX(version), 0) FROM schema_version) END
         """,
-        commit=True,
+        fetchone=True,
     )
-    _db_exec(
+    return int(row[0]) if row else -1
+
+
+async def _drop_invalid_index(conn, name: str) -> None:
+    # A failed CONCURRENTLY build leaves an INVALID index that IF NOT EXISTS would skip
+    cur = await conn.execute(
         """
-        CREATE TABLE IF NOT EXISTS admins (
-            user_id BIGINT PRIMARY KEY,
-            added_by BIGINT,
-            ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
         """,
-        commit=True,
+        (name,),
     )
+    if await cur.fetchone():
+        logger.warning("Dropping invalid index %s before rebuilding it.", name)
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+async def run_migrations() -> None:
+    latest = MIGRATIONS[-1][0]
+    if await get_schema_version() >= latest:
+        return  # Schema current: no DDL at all
+
+    pool = await init_db_pool()
+    async with pool.connection() as conn:
+        # Poll instead of a blocking pg_advisory_lock: a waiting statement holds a snapshot, and
+        # CREATE INDEX CONCURRENTLY in the holder waits for old snapshots -> deadlock.
+        waited = False
+        while True:
+            cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (SCHEMA_MIGRATION_LOCK,))
+            if (await cur.fetchone())[0]:
+                break
+            if not waited:
+                logger.info("Another instance is migrating the schema; waiting.")
+                waited = True
+            await asyncio.sleep(1.0)
+        # Migrations that bucket by day read the bot's time zone from this session setting
+        await conn.execute("SELECT set_config('bot.daily_tz', %s, false)", (DAILY_LIMIT_TZ,))
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            cur = await conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = int((await cur.fetchone())[0])
+
+            for version, description, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                started = time.monotonic()
+                if any(_CONCURRENT_INDEX_RE.search(q) for q in statements):
+                    for q in statements:
+                        m = _CONCURRENT_INDEX_RE.search(q)
+                        if m:
+                            await _drop_invalid_index(conn, m.group(1))
+                        await conn.execute(q)
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                        (version, description),
+                    )
+                else:
+                    async with conn.transaction():
+                        for q in statements:
+                            await conn.execute(q)
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                            (version, description),
+                        )
+                logger.info(
+                    "Migration %s (%s) applied in %.2fs", version, description, time.monotonic() - started
+                )
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATION_LOCK,))
+
+
+async def ensure_schema() -> None:
+    await run_migrations()
 
 
 # ---------------------------- SETTINGS HELPERS ----------------------------
 
-def set_setting(key: str, value: str) -> None:
-    _db_exec(
+# In-memory snapshot of the settings table, loaded at startup and kept fresh via NOTIFY.
+_settings_cache: Dict[str, str] = {}
+_settings_loaded = False
+
+
+async def prime_settings_cache(values: Mapping[str, Optional[str]]) -> None:
+    global _settings_cache, _settings_loaded
+    _settings_cache = {k: v for k, v in values.items() if v is not None}
+    _settings_loaded = True
+    await _on_settings_changed("")
+
+
+async def load_settings_cache() -> None:
+    rows = await _db_exec("SELECT key, value FROM settings", fetchall=True) or []
+    await prime_settings_cache({r[0]: r[1] for r in rows})
+
+
+async def _refresh_setting(key: str) -> None:
+    if not key:
+        await load_settings_cache()
+        return
+    row = await _db_exec("SELECT value FROM settings WHERE key = %s", (key,), fetchone=True)
+    if row and row[0] is not None:
+        _settings_cache[key] = row[0]
+    else:
+        _settings_cache.pop(key, None)
+    await _on_settings_changed(key)
+
+
+async def _on_settings_changed(key: str) -> None:
+    # Derived state that must follow settings ("" = everything reloaded)
+    if key in ("", "font_style"):
+        await load_font_from_db()
+
+
+async def set_setting(key: str, value: str) -> None:
+    # Upsert + notify other instances in the same transaction
+    await _db_exec(
         """
-        INSERT INTO settings (key, value) VALUES (%s, %s)
-        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        WITH up AS (
+            INSERT INTO settings (key, value) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            RETURNING key
+        )
+        SELECT pg_notify(%s, 'settings:' || key) FROM up
         """,
-        (key, value),
-        commit=True,
+        (key, value, CACHE_NOTIFY_CHANNEL),
+        fetchone=True,
     )
+    _settings_cache[key] = value
+    await _on_settings_changed(key)
 
 
-def get_setting(key: str) -> Optional[str]:
-    row = _db_exec("SELECT value FROM settings WHERE key = %s", (key,), fetchone=True)
+async def get_setting(key: str) -> Optional[str]:
+    if _settings_loaded:
+        return _settings_cache.get(key)
+    row = await _db_exec("SELECT value FROM settings WHERE key = %s", (key,), fetchone=True)
     return row[0] if row else None
 
 
-def get_start_photo_id() -> Optional[str]:
-    return get_setting("start_photo_file_id")
+register_cache_topic("settings", _refresh_setting, load_settings_cache)
+
+
+async def get_start_photo_id() -> Optional[str]:
+    return await get_setting("start_photo_file_id")
 
 
 # Delivery join button settings (button shown AFTER media delivery)
-def get_delivery_button() -> Tuple[str, str, str]:
-    link = get_setting("delivery_channel_link") or MAIN_CHANNEL_LINK
-    chat_id = get_setting("delivery_chat_id") or ""
-    name = get_setting("delivery_button_name") or "📢 Join Channel"
+async def get_delivery_button() -> Tuple[str, str, str]:
+    link = await get_setting("delivery_channel_link") or MAIN_CHANNEL_LINK
+    chat_id = await get_setting("delivery_chat_id") or ""
+    name = await get_setting("delivery_button_name") or "📢 Join Channel"
     return link, chat_id, name
 
 
@@ -255,37 +802,57 @@ def _math_alpha(ch: str, base_upper: int, base_lower: int, base_digit: Optional[
     return ch
 
 
-def apply_font(text: str, style: Optional[str] = None) -> str:
-    st = (style or FONT_STYLE or "normal").strip().lower()
-    if st not in FONT_STYLES:
-        st = "normal"
+def _build_font_table(style: str) -> Dict[int, str]:
+    if style == "smallcaps":
+        # Case-insensitive; U+212A (Kelvin sign) is the only non-ASCII char that lowers to a-z
+        return {ord(ch): _SMALLCAPS_MAP[ch.lower()] for ch in string.ascii_letters + "\u212a"}
+    bases = {
+        "bold": (0x1D400, 0x1D41A, 0x1D7CE),
+        "italic": (0x1D434, 0x1D44E, None),
+        "mono": (0x1D670, 0x1D68A, 0x1D7F6),
+    }.get(style)
+    if bases is None:
+        return {}
+    return {ord(ch): _math_alpha(ch, *bases) for ch in string.ascii_letters + string.digits}
 
-    if st == "normal":
-        return text
 
-    if st == "smallcaps":
-        out = []
-        for ch in text:
-            low = ch.lower()
-            out.append(_SMALLCAPS_MAP.get(low, ch))
-        return "".join(out)
+# Compiled once: str.translate runs the whole mapping in C
+_FONT_TABLES: Dict[str, Dict[int, str]] = {st: _build_font_table(st) for st in FONT_STYLES}
 
-    if st == "bold":
-        return "".join(_math_alpha(ch, 0x1D400, 0x1D41A, 0x1D7CE) for ch in text)
+# Rendered constant UI strings (apply_font(..., cache=True)) in the current style;
+# cleared when the style changes
+FONT_CACHE_MAX = 512
+_font_cache: "OrderedDict[str, str]" = OrderedDict()
 
-    if st == "italic":
-        return "".join(_math_alpha(ch, 0x1D434, 0x1D44E, None) for ch in text)
 
-    if st == "mono":
-        return "".join(_math_alpha(ch, 0x1D670, 0x1D68A, 0x1D7F6) for ch in text)
+def apply_font(text: str, style: Optional[str] = None, cache: bool = False) -> str:
+    # cache=True only for constant UI text; dynamic strings would just evict it
+    st = (style or FONT_STYLE or "normal").strip().lower()
+    if st == "normal" or st not in FONT_STYLES:
+        return text
 
-    return text
+    cacheable = cache and style is None
+    if cacheable:
+        out = _font_cache.get(text)
+        if out is not None:
+            _font_cache.move_to_end(text)
+            return out
 
+    out = text.translate(_FONT_TABLES[st])
+    if cacheable:
+        _font_cache[text] = out
+        if len(_font_cache) > FONT_CACHE_MAX:
+            _font_cache.popitem(last=False)
+    return out
 
-def load_font_from_db() -> None:
+
+async def load_font_from_db() -> None:
     global FONT_STYLE
-    v = (get_setting("font_style") or "smallcaps").strip().lower()
-    FONT_STYLE = v if v in FONT_STYLES else "smallcaps"
+    v = (await get_setting("font_style") or "smallcaps").strip().lower()
+    v = v if v in FONT_STYLES else "smallcaps"
+    if v != FONT_STYLE:
+        _font_cache.clear()
+    FONT_STYLE = v
 
 
 # ---------------------------- MESSAGE HELPERS ----------------------------
@@ -295,9 +862,15 @@ def protect_kwargs() -> Dict[str, Any]:
     return {"protect_content": True}
 
 
-async def send_text(msg: Message, text: str, protect: bool = True, **kwargs):
-    # Styled text (may break links if used on URLs)
-    txt = apply_font(text)
+def _retry_after_seconds(e: RetryAfter) -> float:
+    # retry_after is an int on PTB 21, a timedelta on newer versions
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+async def send_text(msg: Message, text: str, protect: bool = True, cache: bool = False, **kwargs):
+    # Styled text (may break links if used on URLs); cache=True for constant messages
+    txt = apply_font(text, cache=cache)
     if protect:
         return await msg.reply_text(txt, **protect_kwargs(), **kwargs)
     return await msg.reply_text(txt, **kwargs)
@@ -314,110 +887,157 @@ async def send_plain_html(msg: Message, html: str, **kwargs):
 
 # ---------------------------- USERS / ADMIN ----------------------------
 
-def ensure_user_record(user_id: int, username: Optional[str]) -> None:
-    _db_exec(
-        """
-        INSERT INTO users (user_id, username, active, premium, banned)
-        VALUES (%s, %s, 1, 0, 0)
-        ON CONFLICT (user_id) DO UPDATE
-          SET username = EXCLUDED.username, active = 1
-        """,
-        (user_id, username),
-        commit=True,
-    )
+# Recently-upserted users: user_id -> (username, written_at monotonic). Lets repeat messages
+# skip the users upsert (write + commit + dead tuple) when nothing changed.
+USER_SEEN_TTL = int(os.getenv("USER_SEEN_TTL", "600").strip())
+USER_SEEN_CACHE_MAX = int(os.getenv("USER_SEEN_CACHE_MAX", "50000").strip())
+
+_user_seen: "OrderedDict[int, Tuple[Optional[str], float]]" = OrderedDict()
+user_seen_stats: Dict[str, int] = {"writes": 0, "skipped": 0}
+
+
+def _user_recently_written(user_id: int, username: Optional[str]) -> bool:
+    entry = _user_seen.get(int(user_id))
+    if entry is None:
+        return False
+    seen_username, written_at = entry
+    if seen_username != username or time.monotonic() - written_at > USER_SEEN_TTL:
+        return False
+    _user_seen.move_to_end(int(user_id))
+    return True
+
+
+def _mark_user_written(user_id: int, username: Optional[str]) -> None:
+    _user_seen[int(user_id)] = (username, time.monotonic())
+    _user_seen.move_to_end(int(user_id))
+    while len(_user_seen) > USER_SEEN_CACHE_MAX:
+        _user_seen.popitem(last=False)
 
 
 def is_owner(user_id: int) -> bool:
     return int(user_id) == int(OWNER_ID)
 
 
-def get_admin_ids_from_db() -> List[int]:
-    rows = _db_exec("SELECT user_id FROM admins", fetchall=True) or []
+async def get_admin_ids_from_db() -> List[int]:
+    rows = await _db_exec("SELECT user_id FROM admins", fetchall=True) or []
     return [int(r[0]) for r in rows]
 
 
-def is_admin(user_id: int) -> bool:
-    return is_owner(user_id) or (int(user_id) in set(get_admin_ids_from_db()))
+# Cached admin set. _admin_version bumps on every local change so a reload that
+# started before the change can't overwrite it with stale rows.
+_admin_ids: frozenset = frozenset()
+_admin_version = 0
+_admins_loaded = False
+
+
+def prime_admin_cache(ids) -> None:
+    global _admin_ids, _admin_version, _admins_loaded
+    _admin_ids = frozenset(int(i) for i in ids)
+    _admin_version += 1
+    _admins_loaded = True
+
+
+async def load_admin_cache(_detail: str = "") -> None:
+    version = _admin_version
+    ids = await get_admin_ids_from_db()
+    if version != _admin_version:
+        return
+    prime_admin_cache(ids)
+
+
+def _admin_cache_apply(user_id: int, present: bool) -> None:
+    global _admin_ids, _admin_version
+    _admin_ids = (_admin_ids | {int(user_id)}) if present else (_admin_ids - {int(user_id)})
+    _admin_version += 1
+
 
+async def is_admin(user_id: int) -> bool:
+    if is_owner(user_id):
+        return True
+    if not _admins_loaded:
+        await load_admin_cache()
+    return int(user_id) in _admin_ids
 
-def add_admin_db(user_id: int, added_by: int) -> None:
+
+async def add_admin_db(user_id: int, added_by: int) -> None:
     if is_owner(user_id):
         return
-    _db_exec(
+    await _db_exec(
         """
-        INSERT INTO admins (user_id, added_by)
-        VALUES (%s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET added_by = EXCLUDED.added_by
+        WITH up AS (
+            INSERT INTO admins (user_id, added_by)
+            VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET added_by = EXCLUDED.added_by
+        )
+        SELECT pg_notify(%s, 'admins:')
         """,
-        (int(user_id), int(added_by)),
-        commit=True,
+        (int(user_id), int(added_by), CACHE_NOTIFY_CHANNEL),
+        fetchone=True,
     )
+    _admin_cache_apply(user_id, True)
 
 
-def remove_admin_db(user_id: int) -> bool:
+async def remove_admin_db(user_id: int) -> bool:
     if is_owner(user_id):
         return False
-    _db_exec("DELETE FROM admins WHERE user_id = %s", (int(user_id),), commit=True)
+    await _db_exec(
+        """
+        WITH d AS (DELETE FROM admins WHERE user_id = %s)
+        SELECT pg_notify(%s, 'admins:')
+        """,
+        (int(user_id), CACHE_NOTIFY_CHANNEL),
+        fetchone=True,
+    )
+    _admin_cache_apply(user_id, False)
     return True
 
 
-def list_admins_all() -> List[int]:
-    ids = set(get_admin_ids_from_db())
+async def list_admins_all() -> List[int]:
+    ids = set(await get_admin_ids_from_db())
     ids.add(int(OWNER_ID))
     return sorted(ids)
 
 
-def set_premium(user_id: int, value: bool) -> None:
-    _db_exec(
+register_cache_topic("admins", load_admin_cache, load_admin_cache)
+
+
+async def set_premium(user_id: int, value: bool) -> None:
+    await _db_exec(
         """
         INSERT INTO users (user_id, username, active, premium, banned)
         VALUES (%s, NULL, 1, 0, 0)
         ON CONFLICT (user_id) DO NOTHING
         """,
         (user_id,),
-        commit=True,
     )
-    _db_exec(
+    await _db_exec(
         "UPDATE users SET premium = %s WHERE user_id = %s",
         (1 if value else 0, user_id),
-        commit=True,
     )
 
 
-def is_premium(user_id: int) -> bool:
-    row = _db_exec("SELECT premium FROM users WHERE user_id = %s", (user_id,), fetchone=True)
-    return bool(row and row[0])
-
-
-def ban_user(user_id: int) -> None:
-    _db_exec(
+async def ban_user(user_id: int) -> None:
+    await _db_exec(
         """
         INSERT INTO users (user_id, username, active, premium, banned)
         VALUES (%s, NULL, 1, 0, 0)
         ON CONFLICT (user_id) DO NOTHING
         """,
         (user_id,),
-        commit=True,
     )
-    _db_exec("UPDATE users SET banned = 1 WHERE user_id = %s", (user_id,), commit=True)
+    await _db_exec("UPDATE users SET banned = 1 WHERE user_id = %s", (user_id,))
 
 
-def unban_user(user_id: int) -> None:
-    _db_exec(
+async def unban_user(user_id: int) -> None:
+    await _db_exec(
         """
         INSERT INTO users (user_id, username, active, premium, banned)
         VALUES (%s, NULL, 1, 0, 0)
         ON CONFLICT (user_id) DO NOTHING
         """,
         (user_id,),
-        commit=True,
     )
-    _db_exec("UPDATE users SET banned = 0 WHERE user_id = %s", (user_id,), commit=True)
-
-
-def is_banned(user_id: int) -> bool:
-    row = _db_exec("SELECT banned FROM users WHERE user_id = %s", (user_id,), fetchone=True)
-    return bool(row and row[0])
+    await _db_exec("UPDATE users SET banned = 0 WHERE user_id = %s", (user_id,))
 
 
 # ---------------------------- MEDIA STORAGE ----------------------------
@@ -426,45 +1046,421 @@ def gen_id(length: int = 12) -> str:
     return "".join(random.choices(string.ascii_letters + string.digits, k=length))
 
 
-def save_data(media_id: str, files: list) -> None:
-    _db_exec(
+# Decoded manifests: media_id -> (files or None, size_bytes, expires_at; 0 = no expiry).
+# Bounded by entry count and total (approximate) bytes; unknown ids are cached briefly (negative).
+MEDIA_CACHE_MAX_ITEMS = int(os.getenv("MEDIA_CACHE_MAX_ITEMS", "5000").strip())
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(16 * 1024 * 1024)).strip())
+MEDIA_CACHE_NEGATIVE_TTL = int(os.getenv("MEDIA_CACHE_NEGATIVE_TTL", "30").strip())
+
+MediaManifest = Tuple[Mapping[str, Any], ...]
+
+_media_cache: "OrderedDict[str, Tuple[Optional[MediaManifest], int, float]]" = OrderedDict()
+_media_cache_bytes = 0
+_media_cache_gen = 0  # bumped on invalidation so in-flight loads don't re-cache stale rows
+media_cache_stats: Dict[str, int] = {"hits": 0, "neg_hits": 0, "misses": 0, "evictions": 0}
+
+
+def _freeze_manifest(files: list) -> MediaManifest:
+    return tuple(MappingProxyType(dict(f)) for f in files if isinstance(f, dict))
+
+
+def _media_cache_drop(media_id: str) -> None:
+    global _media_cache_bytes
+    entry = _media_cache.pop(media_id, None)
+    if entry is not None:
+        _media_cache_bytes -= entry[1]
+
+
+def _media_cache_put(media_id: str, files: Optional[MediaManifest], size: int) -> None:
+    global _media_cache_bytes
+    if files is None:
+        if MEDIA_CACHE_NEGATIVE_TTL <= 0:
+            return
+        expires_at = time.monotonic() + MEDIA_CACHE_NEGATIVE_TTL
+    else:
+        if size > MEDIA_CACHE_MAX_BYTES:
+            return
+        expires_at = 0.0
+    _media_cache_drop(media_id)
+    _media_cache[media_id] = (files, size, expires_at)
+    _media_cache_bytes += size
+    while len(_media_cache) > MEDIA_CACHE_MAX_ITEMS or _media_cache_bytes > MEDIA_CACHE_MAX_BYTES:
+        _, (_, old_size, _) = _media_cache.popitem(last=False)
+        _media_cache_bytes -= old_size
+        media_cache_stats["evictions"] += 1
+
+
+def invalidate_media_cache(media_id: str) -> None:
+    global _media_cache_gen
+    _media_cache_gen += 1
+    _media_cache_drop(media_id)
+
+
+async def _on_media_notify(media_id: str) -> None:
+    invalidate_media_cache(media_id)
+
+
+async def _on_media_resync() -> None:
+    global _media_cache_bytes, _media_cache_gen
+    _media_cache_gen += 1
+    _media_cache.clear()
+    _media_cache_bytes = 0
+
+
+register_cache_topic("media", _on_media_notify, _on_media_resync)
+
+
+async def save_data(media_id: str, files: list) -> None:
+    # media_files keeps the bundle header; items go to media_items in one bulk insert
+    types_ = [str(f.get("type") or "") for f in files]
+    file_ids = [str(f.get("file_id") or "") for f in files]
+    unique_ids = [f.get("file_unique_id") for f in files]
+    captions = [f.get("caption", "") or "" for f in files]
+    await _db_exec(
         """
-        INSERT INTO media_files (media_id, files) VALUES (%s, %s)
-        ON CONFLICT (media_id) DO UPDATE SET files = EXCLUDED.files
+        WITH h AS (
+            INSERT INTO media_files (media_id, files) VALUES (%s, NULL)
+            ON CONFLICT (media_id) DO UPDATE SET files = NULL
+        ),
+        stale AS (
+            DELETE FROM media_items WHERE media_id = %s AND position >= %s
+        ),
+        ins AS (
+            INSERT INTO media_items (media_id, position, type, file_id, file_unique_id, caption)
+            SELECT %s, (t.ord - 1)::int, t.type, t.file_id, t.file_unique_id, t.caption
+            FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[])
+                 WITH ORDINALITY AS t(type, file_id, file_unique_id, caption, ord)
+            ON CONFLICT (media_id, position) DO UPDATE
+              SET type = EXCLUDED.type, file_id = EXCLUDED.file_id,
+                  file_unique_id = EXCLUDED.file_unique_id, caption = EXCLUDED.caption
+        )
+        SELECT pg_notify(%s, 'media:' || %s)
         """,
-        (media_id, json.dumps(files, ensure_ascii=False)),
-        commit=True,
+        (
+            media_id,
+            media_id, len(files),
+            media_id, types_, file_ids, unique_ids, captions,
+            CACHE_NOTIFY_CHANNEL, media_id,
+        ),
+        fetchone=True,
     )
+    invalidate_media_cache(media_id)
 
 
-def get_data(media_id: str) -> Optional[list]:
-    row = _db_exec("SELECT files FROM media_files WHERE media_id = %s", (media_id,), fetchone=True)
+async def delete_media(media_id: str) -> None:
+    await _db_exec(
+        """
+        WITH i AS (DELETE FROM media_items WHERE media_id = %s),
+        d AS (DELETE FROM media_files WHERE media_id = %s),
+        s AS (DELETE FROM media_stats WHERE media_id = %s),
+        ds AS (DELETE FROM media_daily_stats WHERE media_id = %s)
+        SELECT pg_notify(%s, 'media:' || %s)
+        """,
+        (media_id, media_id, media_id, media_id, CACHE_NOTIFY_CHANNEL, media_id),
+        fetchone=True,
+    )
+    invalidate_media_cache(media_id)
+
+
+async def _load_manifest(media_id: str) -> Tuple[Optional[list], int]:
+    # Ordered PK scan over media_items; legacy JSON rows (not backfilled) as a fallback
+    rows = await _db_exec(
+        """
+        SELECT type, file_id, file_unique_id, caption
+        FROM media_items WHERE media_id = %s
+        ORDER BY position
+        """,
+        (media_id,),
+        fetchall=True,
+    ) or []
+    if rows:
+        files = [
+            {"type": t, "file_id": fid, "file_unique_id": uid, "caption": cap or ""}
+            for t, fid, uid, cap in rows
+        ]
+        size = sum(len(fid) + len(uid or "") + len(cap or "") + 64 for _, fid, uid, cap in rows)
+        return files, size
+
+    row = await _db_exec(
+        "SELECT files FROM media_files WHERE media_id = %s AND files IS NOT NULL",
+        (media_id,),
+        fetchone=True,
+    )
     if not row:
-        return None
+        return None, 0
     try:
-        return json.loads(row[0])
+        return json.loads(row[0]), len(row[0] or "")
     except Exception:
-        return None
+        return None, 0
 
 
-def log_download(media_id: str, user_id: int) -> None:
-    _db_exec("INSERT INTO downloads (media_id, user_id) VALUES (%s, %s)", (media_id, user_id), commit=True)
+async def get_data(media_id: str) -> Optional[MediaManifest]:
+    entry = _media_cache.get(media_id)
+    if entry is not None:
+        files, _, expires_at = entry
+        if expires_at and expires_at <= time.monotonic():
+            _media_cache_drop(media_id)
+        else:
+            _media_cache.move_to_end(media_id)
+            media_cache_stats["neg_hits" if files is None else "hits"] += 1
+            return files
 
+    media_cache_stats["misses"] += 1
+    gen = _media_cache_gen
+    raw, size = await _load_manifest(media_id)
+    files = _freeze_manifest(raw) if raw else None
+    if gen == _media_cache_gen:
+        _media_cache_put(media_id, files, size)
+    return files
 
-def get_nonbanned_user_ids() -> List[int]:
-    rows = _db_exec("SELECT user_id FROM users WHERE banned = 0", fetchall=True) or []
-    return [int(r[0]) for r in rows]
 
+# Write-behind download log: delivery only enqueues; one task flushes batches.
+DOWNLOAD_LOG_BATCH = int(os.getenv("DOWNLOAD_LOG_BATCH", "500").strip())
+DOWNLOAD_LOG_FLUSH_MS = int(os.getenv("DOWNLOAD_LOG_FLUSH_MS", "250").strip())
+DOWNLOAD_LOG_MAX_PENDING = int(os.getenv("DOWNLOAD_LOG_MAX_PENDING", "20000").strip())
+
+_download_queue: Optional[asyncio.Queue] = None
+_download_task: Optional[asyncio.Task] = None
+
+
+async def write_downloads(events: List[Tuple[str, int, datetime]]) -> None:
+    # Bulk insert raw events + bump per-user daily counters and per-media aggregates
+    # (days in DAILY_LIMIT_TZ), one statement
+    if not events:
+        return
+    media_ids = [e[0] for e in events]
+    user_ids = [int(e[1]) for e in events]
+    stamps = [e[2] for e in events]
+    await _db_exec(
+        """
+        WITH ev AS (
+            SELECT * FROM unnest(%s::text[], %s::bigint[], %s::timestamptz[]) AS e(media_id, user_id, ts)
+        ),
+        d AS (
+            INSERT INTO downloads (media_id, user_id, ts)
+            SELECT media_id, user_id, ts::timestamp FROM ev
+        ),
+        ms AS (
+            INSERT INTO media_stats (media_id, total, last_download_at, registers)
+            SELECT media_id, COUNT(*), MAX(ts), hll_registers(array_agg(user_id)) FROM ev GROUP BY media_id
+            ON CONFLICT (media_id) DO UPDATE SET
+                total = media_stats.total + EXCLUDED.total,
+                last_download_at = GREATEST(media_stats.last_download_at, EXCLUDED.last_download_at),
+                registers = hll_merge(media_stats.registers, EXCLUDED.registers)
+        ),
+        md AS (
+            INSERT INTO media_daily_stats (media_id, day, count)
+            SELECT media_id, timezone(%s, ts)::date, COUNT(*) FROM ev GROUP BY 1, 2
+            ON CONFLICT (media_id, day) DO UPDATE SET count = media_daily_stats.count + EXCLUDED.count
+        )
+        INSERT INTO user_daily_usage (user_id, day, count)
+        SELECT user_id, timezone(%s, ts)::date, COUNT(*) FROM ev GROUP BY 1, 2
+        ON CONFLICT (user_id, day) DO UPDATE SET count = user_daily_usage.count + EXCLUDED.count
+        """,
+        (media_ids, user_ids, stamps, DAILY_LIMIT_TZ, DAILY_LIMIT_TZ),
+    )
 
-def get_premium_user_ids() -> List[int]:
-    rows = _db_exec("SELECT user_id FROM users WHERE banned = 0 AND premium = 1", fetchall=True) or []
-    return [int(r[0]) for r in rows]
+
+async def log_download(media_id: str, user_id: int) -> None:
+    event = (media_id, int(user_id), datetime.now(timezone.utc))
+    if _download_queue is None:
+        await write_downloads([event])
+        return
+    # Bounded queue: when the DB falls behind, callers wait here (backpressure)
+    await _download_queue.put(event)
+
+
+async def _flush_with_retry(batch: List[Tuple[str, int, datetime]]) -> None:
+    delay = 0.5
+    for attempt in range(5):
+        try:
+            await write_downloads(batch)
+            return
+        except Exception as e:
+            logger.warning("Download log flush failed (%s rows, attempt %s): %s", len(batch), attempt + 1, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10.0)
+    logger.error("Dropping %s download log rows after repeated failures.", len(batch))
+
+
+async def _download_flusher() -> None:
+    # Flush every DOWNLOAD_LOG_FLUSH_MS or DOWNLOAD_LOG_BATCH rows; a None item means "flush and stop"
+    assert _download_queue is not None
+    interval = DOWNLOAD_LOG_FLUSH_MS / 1000.0
+    while True:
+        first = await _download_queue.get()
+        if first is None:
+            return
+        batch = [first]
+        stop = False
+        deadline = time.monotonic() + interval
+        while len(batch) < DOWNLOAD_LOG_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_download_queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        await _flush_with_retry(batch)
+        if stop:
+            return
+
+
+def start_download_logger() -> None:
+    global _download_queue, _download_task
+    if _download_task is not None and not _download_task.done():
+        return
+    _download_queue = asyncio.Queue(maxsize=DOWNLOAD_LOG_MAX_PENDING)
+    _download_task = asyncio.create_task(_download_flusher())
+
+
+async def stop_download_logger(timeout: float = 15.0) -> None:
+    # Final flush on shutdown: the sentinel sits behind every queued event
+    global _download_queue, _download_task
+    queue, task = _download_queue, _download_task
+    _download_queue, _download_task = None, None  # new events now write through directly
+    if queue is None or task is None:
+        return
+    try:
+        await asyncio.wait_for(queue.put(None), timeout=timeout)
+        await asyncio.wait_for(task, timeout=timeout)
+    except (asyncio.TimeoutError, Exception) as e:
+        task.cancel()
+        logger.error("Download log did not flush cleanly on shutdown (%s pending): %s", queue.qsize(), e)
+
+
+# ---------------------------- COUNTERS ----------------------------
+
+# bot_counters is kept current by triggers; this periodic full recount only corrects drift.
+COUNTERS_RECONCILE_SECONDS = int(os.getenv("COUNTERS_RECONCILE_SECONDS", "3600").strip())
+
+_reconcile_task: Optional[asyncio.Task] = None
+
+
+async def get_bot_counters() -> Dict[str, int]:
+    # Single-row read + cheap extras from the daily usage counters
+    row = await _db_exec(
+        """
+        SELECT c.users, c.banned, c.premium, c.downloads,
+               (SELECT COALESCE(SUM(count), 0) FROM user_daily_usage
+                 WHERE day = timezone(%s, now())::date),
+               (SELECT COUNT(DISTINCT user_id) FROM user_daily_usage
+                 WHERE day > timezone(%s, now())::date - 7)
+        FROM bot_counters c WHERE c.id = 1
+        """,
+        (DAILY_LIMIT_TZ, DAILY_LIMIT_TZ),
+        fetchone=True,
+    )
+    keys = ("users", "banned", "premium", "downloads", "downloads_today", "active_7d")
+    return dict(zip(keys, (int(v or 0) for v in row))) if row else {k: 0 for k in keys}
+
+
+async def reconcile_bot_counters() -> None:
+    await _db_exec(
+        """
+        UPDATE bot_counters SET
+            users = (SELECT COUNT(*) FROM users),
+            banned = (SELECT COUNT(*) FROM users WHERE banned = 1),
+            premium = (SELECT COUNT(*) FROM users WHERE premium = 1),
+            downloads = (SELECT COUNT(*) FROM downloads),
+            reconciled_at = now()
+        WHERE id = 1
+        """,
+    )
+
+
+async def _reconcile_loop() -> None:
+    while True:
+        await asyncio.sleep(COUNTERS_RECONCILE_SECONDS)
+        try:
+            started = time.monotonic()
+            await reconcile_bot_counters()
+            logger.info("Counters reconciled in %.2fs", time.monotonic() - started)
+        except Exception as e:
+            logger.warning("Counter reconciliation failed: %s", e)
+
+
+def start_counter_reconciler() -> None:
+    global _reconcile_task
+    if COUNTERS_RECONCILE_SECONDS <= 0:
+        return
+    if _reconcile_task is None or _reconcile_task.done():
+        _reconcile_task = asyncio.create_task(_reconcile_loop())
+
+
+async def stop_counter_reconciler() -> None:
+    global _reconcile_task
+    if _reconcile_task is None:
+        return
+    _reconcile_task.cancel()
+    try:
+        await _reconcile_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    _reconcile_task = None
+
+
+# ---------------------------- MEDIA STATS ----------------------------
+
+HLL_REGISTERS = 1024
+TOP_PERIODS = {"today": 1, "7d": 7, "30d": 30, "all": 0}
+
+
+def hll_estimate(registers: Sequence[int]) -> int:
+    # Standard HyperLogLog estimate with linear counting for small cardinalities
+    m = len(registers) or HLL_REGISTERS
+    z = sum(2.0 ** -int(r or 0) for r in registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / z if z else 0.0
+    zeros = sum(1 for r in registers if not r)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+
+async def get_media_stats(media_id: str) -> Optional[Tuple[int, Optional[datetime], int]]:
+    row = await _db_exec(
+        "SELECT total, last_download_at, registers FROM media_stats WHERE media_id = %s",
+        (media_id,),
+        fetchone=True,
+    )
+    if not row:
+        return None
+    return int(row[0]), row[1], hll_estimate(row[2] or [])
+
+
+async def get_top_media(period: str, limit: int = 10) -> List[Tuple[str, int]]:
+    days = TOP_PERIODS.get(period, 7)
+    if days <= 0:
+        rows = await _db_exec(
+            "SELECT media_id, total FROM media_stats ORDER BY total DESC LIMIT %s",
+            (int(limit),),
+            fetchall=True,
+        ) or []
+    else:
+        rows = await _db_exec(
+            """
+            SELECT media_id, SUM(count) AS n
+            FROM media_daily_stats
+            WHERE day > timezone(%s, now())::date - %s
+            GROUP BY media_id
+            ORDER BY n DESC
+            LIMIT %s
+            """,
+            (DAILY_LIMIT_TZ, int(days), int(limit)),
+            fetchall=True,
+        ) or []
+    return [(r[0], int(r[1])) for r in rows]
 
 
 # ---------------------------- DAILY LIMIT ----------------------------
 
-def get_daily_limit() -> int:
-    v = get_setting("daily_limit")
+def _parse_daily_limit(v: Optional[str]) -> int:
     if not v:
         return 0
     try:
@@ -473,60 +1469,194 @@ def get_daily_limit() -> int:
         return 0
 
 
-def set_daily_limit(limit: int) -> None:
-    set_setting("daily_limit", str(max(0, int(limit))))
+async def get_daily_limit() -> int:
+    return _parse_daily_limit(await get_setting("daily_limit"))
 
 
-def remove_daily_limit() -> None:
-    set_setting("daily_limit", "0")
+async def set_daily_limit(limit: int) -> None:
+    await set_setting("daily_limit", str(max(0, int(limit))))
 
 
-def count_user_downloads_today(user_id: int) -> int:
-    row = _db_exec(
-        """
-        SELECT COUNT(*)
-        FROM downloads
-        WHERE user_id = %s
-          AND DATE(timezone(%s, ts)) = DATE(timezone(%s, now()))
+async def remove_daily_limit() -> None:
+    await set_setting("daily_limit", "0")
+
+
+async def rebuild_daily_usage(days: int = 0) -> int:
+    # Recompute user_daily_usage from downloads (days=0: full history, else the last N days)
+    # ts is a plain TIMESTAMP written in the session time zone; ::timestamptz restores the instant
+    since = "" if days <= 0 else "WHERE timezone(%s, ts::timestamptz)::date > timezone(%s, now())::date - %s"
+    since_params: Tuple[Any, ...] = () if days <= 0 else (DAILY_LIMIT_TZ, DAILY_LIMIT_TZ, int(days))
+    row = await _db_exec(
+        f"""
+        WITH agg AS (
+            SELECT user_id, timezone(%s, ts::timestamptz)::date AS day, COUNT(*)::int AS n
+            FROM downloads
+            {since}
+            GROUP BY 1, 2
+        ),
+        up AS (
+            INSERT INTO user_daily_usage (user_id, day, count)
+            SELECT user_id, day, n FROM agg
+            ON CONFLICT (user_id, day) DO UPDATE SET count = EXCLUDED.count
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM up
         """,
-        (user_id, DAILY_LIMIT_TZ, DAILY_LIMIT_TZ),
+        (DAILY_LIMIT_TZ,) + since_params,
         fetchone=True,
     )
     return int(row[0]) if row else 0
 
 
+# ---------------------------- USER CONTEXT ----------------------------
+
+class UserContext(NamedTuple):
+    # Per-update snapshot of everything the access checks need (immutable).
+    user_id: int
+    banned: bool
+    premium: bool
+    admin: bool
+    downloads_today: int
+    daily_limit: int  # effective limit: 0 = unlimited (premium/admin or limit OFF)
+
+    @property
+    def limit_reached(self) -> bool:
+        return self.daily_limit > 0 and self.downloads_today >= self.daily_limit
+
+
+async def load_user_context(user_id: int, username: Optional[str]) -> UserContext:
+    # One round trip: upsert the user and read ban/premium/usage together (admins + limit are cached).
+    # If we wrote this user recently with the same username, a plain read is enough.
+    row = None
+    if _user_recently_written(user_id, username):
+        row = await _db_exec(
+            """
+            SELECT
+                u.banned,
+                u.premium,
+                (
+                    SELECT count
+                    FROM user_daily_usage
+                    WHERE user_id = %s AND day = timezone(%s, now())::date
+                )
+            FROM users u
+            WHERE u.user_id = %s
+            """,
+            (user_id, DAILY_LIMIT_TZ, user_id),
+            fetchone=True,
+        )
+        if row:
+            user_seen_stats["skipped"] += 1
+
+    if not row:
+        row = await _db_exec(
+            """
+            WITH u AS (
+                INSERT INTO users (user_id, username, active, premium, banned)
+                VALUES (%s, %s, 1, 0, 0)
+                ON CONFLICT (user_id) DO UPDATE
+                  SET username = EXCLUDED.username, active = 1
+                RETURNING premium, banned
+            )
+            SELECT
+                u.banned,
+                u.premium,
+                (
+                    SELECT count
+                    FROM user_daily_usage
+                    WHERE user_id = %s AND day = timezone(%s, now())::date
+                )
+            FROM u
+            """,
+            (user_id, username, user_id, DAILY_LIMIT_TZ),
+            fetchone=True,
+        )
+        user_seen_stats["writes"] += 1
+        _mark_user_written(user_id, username)
+
+    banned, premium, used = row if row else (0, 0, 0)
+    admin = await is_admin(user_id)
+    premium = bool(premium)
+    limit = 0 if (premium or admin) else await get_daily_limit()
+    return UserContext(
+        user_id=int(user_id),
+        banned=bool(banned),
+        premium=premium,
+        admin=admin,
+        downloads_today=int(used or 0),
+        daily_limit=limit,
+    )
+
+
 # ---------------------------- FORCE JOIN ----------------------------
 
-def add_force_channel(channel_link: str, chat_id: str, button_name: str) -> None:
-    _db_exec(
+# Enabled force-join channels, checked on every gated request; kept fresh via NOTIFY.
+_force_channels: Optional[List[Tuple[str, str, str]]] = None
+
+
+def prime_force_channels(rows) -> None:
+    global _force_channels
+    _force_channels = [(r[0], r[1], r[2]) for r in rows]
+
+
+async def load_force_channels(_detail: str = "") -> None:
+    rows = await _db_exec(
+        "SELECT channel_link, chat_id, button_name FROM force_join_channels WHERE enabled = 1 ORDER BY id ASC",
+        fetchall=True,
+    ) or []
+    prime_force_channels(rows)
+
+
+async def add_force_channel(channel_link: str, chat_id: str, button_name: str) -> None:
+    await _db_exec(
         """
-        INSERT INTO force_join_channels (channel_link, chat_id, button_name, enabled)
-        VALUES (%s, %s, %s, 1)
-        ON CONFLICT (channel_link, chat_id, button_name) DO UPDATE SET enabled = 1
+        WITH up AS (
+            INSERT INTO force_join_channels (channel_link, chat_id, button_name, enabled)
+            VALUES (%s, %s, %s, 1)
+            ON CONFLICT (channel_link, chat_id, button_name) DO UPDATE SET enabled = 1
+        )
+        SELECT pg_notify(%s, 'force_channels:')
         """,
-        (channel_link.strip(), str(chat_id).strip(), button_name.strip()),
-        commit=True,
+        (channel_link.strip(), str(chat_id).strip(), button_name.strip(), CACHE_NOTIFY_CHANNEL),
+        fetchone=True,
     )
+    await load_force_channels()
 
 
-def remove_force_channel(channel_link: str, chat_id: str, button_name: str) -> None:
-    _db_exec(
-        "DELETE FROM force_join_channels WHERE channel_link = %s AND chat_id = %s AND button_name = %s",
-        (channel_link.strip(), str(chat_id).strip(), button_name.strip()),
-        commit=True,
+async def remove_force_channel(channel_link: str, chat_id: str, button_name: str) -> None:
+    await _db_exec(
+        """
+        WITH d AS (
+            DELETE FROM force_join_channels
+            WHERE channel_link = %s AND chat_id = %s AND button_name = %s
+        )
+        SELECT pg_notify(%s, 'force_channels:')
+        """,
+        (channel_link.strip(), str(chat_id).strip(), button_name.strip(), CACHE_NOTIFY_CHANNEL),
+        fetchone=True,
     )
+    await load_force_channels()
 
 
-def get_force_channels() -> List[Tuple[str, str, str]]:
-    rows = _db_exec(
-        "SELECT channel_link, chat_id, button_name FROM force_join_channels WHERE enabled = 1 ORDER BY id ASC",
-        fetchall=True,
-    ) or []
-    return [(r[0], r[1], r[2]) for r in rows]
+async def get_force_channels() -> List[Tuple[str, str, str]]:
+    if _force_channels is None:
+        await load_force_channels()
+    return list(_force_channels or [])
+
+
+register_cache_topic("force_channels", load_force_channels, load_force_channels)
 
 
-def ensure_default_force_channel() -> None:
-    add_force_channel(DEFAULT_FORCE_CHANNEL_LINK, str(DEFAULT_FORCE_CHANNEL_ID), DEFAULT_FORCE_BUTTON_NAME)
+async def ensure_default_force_channel() -> None:
+    # Boot-time only: no NOTIFY/reload, the warm-up preload reads the table right after
+    await _db_exec(
+        """
+        INSERT INTO force_join_channels (channel_link, chat_id, button_name, enabled)
+        VALUES (%s, %s, %s, 1)
+        ON CONFLICT (channel_link, chat_id, button_name) DO NOTHING
+        """,
+        (DEFAULT_FORCE_CHANNEL_LINK.strip(), str(DEFAULT_FORCE_CHANNEL_ID).strip(), DEFAULT_FORCE_BUTTON_NAME.strip()),
+    )
 
 
 def _chat_identifier_from_chat_id(chat_id_str: str):
@@ -537,38 +1667,294 @@ def _chat_identifier_from_chat_id(chat_id_str: str):
         return s if s.startswith("@") else f"@{s}"
 
 
-async def check_force_join_for_user(bot, user_id: int) -> Tuple[bool, List[Tuple[str, str, str]]]:
-    channels = get_force_channels()
+# (user_id, chat_id) -> (is_member, expires_at monotonic)
+_membership_cache: "OrderedDict[Tuple[int, str], Tuple[bool, float]]" = OrderedDict()
+membership_stats: Dict[str, int] = {"hits": 0, "misses": 0, "neg_hits": 0, "bypassed": 0}
+
+
+def _membership_get(user_id: int, chat_id: str, bypass_negative: bool) -> Optional[bool]:
+    key = (int(user_id), str(chat_id))
+    entry = _membership_cache.get(key)
+    if entry is None:
+        return None
+    is_member, expires_at = entry
+    if expires_at <= time.monotonic():
+        _membership_cache.pop(key, None)
+        return None
+    if not is_member and bypass_negative:
+        membership_stats["bypassed"] += 1
+        return None
+    _membership_cache.move_to_end(key)
+    return is_member
+
+
+def _membership_put(user_id: int, chat_id: str, is_member: bool) -> None:
+    ttl = FORCE_JOIN_MEMBER_TTL if is_member else FORCE_JOIN_NEGATIVE_TTL
+    if ttl <= 0:
+        return
+    key = (int(user_id), str(chat_id))
+    _membership_cache[key] = (is_member, time.monotonic() + ttl)
+    _membership_cache.move_to_end(key)
+    while len(_membership_cache) > FORCE_JOIN_CACHE_MAX:
+        _membership_cache.popitem(last=False)
+
+
+class ForceJoinResult(NamedTuple):
+    ok: bool
+    missing: List[Tuple[str, str, str]]
+    verified: List[str]  # chat_ids answered by the API or the cache
+    assumed: List[str]  # chat_ids that hit the deadline and were decided by policy
+
+
+async def _fetch_membership(bot, user_id: int, chat_id: str) -> bool:
+    try:
+        ident = _chat_identifier_from_chat_id(chat_id)
+        member = await bot.get_chat_member(ident, user_id, read_timeout=FORCE_JOIN_DEADLINE)
+        is_member = member.status not in ("left", "kicked")
+    except Exception:
+        is_member = False
+    _membership_put(user_id, chat_id, is_member)
+    return is_member
+
+
+async def verify_force_join(bot, user_id: int, bypass_negative: bool = False) -> ForceJoinResult:
+    # bypass_negative: re-check channels cached as "left" (used by the "I Joined" button)
+    channels = await get_force_channels()
     if not channels:
-        return True, []
+        return ForceJoinResult(True, [], [], [])
 
     missing: List[Tuple[str, str, str]] = []
-    for channel_link, chat_id, button_name in channels:
-        try:
-            ident = _chat_identifier_from_chat_id(chat_id)
-            member = await bot.get_chat_member(ident, user_id)
-            if member.status in ("left", "kicked"):
-                missing.append((channel_link, chat_id, button_name))
-        except Exception:
-            missing.append((channel_link, chat_id, button_name))
+    verified: List[str] = []
+    assumed: List[str] = []
+    pending: Dict[asyncio.Task, Tuple[str, str, str]] = {}
+
+    for ch in channels:
+        chat_id = ch[1]
+        cached = _membership_get(user_id, chat_id, bypass_negative)
+        if cached is not None:
+            membership_stats["hits"] += 1
+            verified.append(chat_id)
+            if not cached:
+                membership_stats["neg_hits"] += 1
+                missing.append(ch)
+            continue
+        membership_stats["misses"] += 1
+        pending[asyncio.create_task(_fetch_membership(bot, user_id, chat_id))] = ch
+
+    if pending:
+        done, not_done = await asyncio.wait(pending.keys(), timeout=FORCE_JOIN_DEADLINE)
+        for task in not_done:
+            task.cancel()
+        for task, ch in pending.items():
+            if task in done:
+                verified.append(ch[1])
+                if not task.result():
+                    missing.append(ch)
+            else:
+                assumed.append(ch[1])
+                if FORCE_JOIN_TIMEOUT_POLICY != "open":
+                    missing.append(ch)
+
+    if assumed:
+        logger.warning(
+            "Force-join deadline hit for user %s: %s assumed %s",
+            user_id,
+            ",".join(assumed),
+            "joined" if FORCE_JOIN_TIMEOUT_POLICY == "open" else "not joined",
+        )
+
+    # Keep the configured channel order for the join buttons
+    order = {id(ch): i for i, ch in enumerate(channels)}
+    missing.sort(key=lambda ch: order.get(id(ch), 0))
+    return ForceJoinResult(len(missing) == 0, missing, verified, assumed)
+
 
-    return (len(missing) == 0), missing
+async def check_force_join_for_user(
+    bot, user_id: int, bypass_negative: bool = False
+) -> Tuple[bool, List[Tuple[str, str, str]]]:
+    res = await verify_force_join(bot, user_id, bypass_negative)
+    return res.ok, res.missing
 
 
 # ---------------------------- AUTO DELETE ----------------------------
 
-async def schedule_delete_message(bot, chat_id: int, message_id: int, delay: int):
-    if delay <= 0:
+# Pending deletions live in the DB (survive restarts) and in one min-heap of
+# (due_epoch, chat_id, message_id) drained by a single worker task. Only the serving process
+# runs the worker; it also sweeps the DB for overdue rows it did not schedule itself.
+DELETE_BATCH_MAX = 100  # Bot API deleteMessages limit
+DELETE_RETRY_SECONDS = 30.0  # backoff after network errors / repeated flood waits
+DELETE_SWEEP_SECONDS = max(1.0, float(os.getenv("DELETE_SWEEP_SECONDS", "10").strip()))
+
+_delete_heap: List[Tuple[float, int, int]] = []
+_delete_wakeup: Optional[asyncio.Event] = None
+_delete_task: Optional[asyncio.Task] = None
+
+
+def _push_deletion(due: float, chat_id: int, message_id: int) -> None:
+    if _delete_wakeup is None:
+        return  # deletions duty is held by another process; the DB row reaches it
+    heapq.heappush(_delete_heap, (due, int(chat_id), int(message_id)))
+    if _delete_wakeup is not None and _delete_heap[0][0] == due:
+        _delete_wakeup.set()
+
+
+async def schedule_delete_messages(chat_id: int, message_ids: List[int], delay: int) -> None:
+    if delay <= 0 or not message_ids:
         return
 
-    async def _delete():
+    due = time.time() + delay
+    ids = [int(m) for m in message_ids]
+    try:
+        await _db_exec(
+            """
+            INSERT INTO pending_deletions (chat_id, message_id, due_at)
+            SELECT %s, m, to_timestamp(%s) FROM unnest(%s::bigint[]) AS m
+            ON CONFLICT (chat_id, message_id) DO UPDATE SET due_at = EXCLUDED.due_at
+            """,
+            (int(chat_id), due, ids),
+        )
+    except Exception as e:
+        # Still delete from memory; only restart-survival is lost
+        logger.warning("Could not persist pending deletions for chat %s: %s", chat_id, e)
+
+    for mid in ids:
+        _push_deletion(due, chat_id, mid)
+
+
+async def load_pending_deletions() -> int:
+    rows = await _db_exec(
+        "SELECT chat_id, message_id, EXTRACT(EPOCH FROM due_at) FROM pending_deletions",
+        fetchall=True,
+    ) or []
+    for chat_id, message_id, due in rows:
+        _push_deletion(float(due), chat_id, message_id)
+    return len(rows)
+
+
+async def sweep_overdue_deletions() -> int:
+    # Rows past due by more than a sweep interval were not scheduled here (or were missed)
+    rows = await _db_exec(
+        """
+        SELECT chat_id, message_id FROM pending_deletions
+        WHERE due_at <= now() - make_interval(secs => %s)
+        ORDER BY due_at LIMIT 5000
+        """,
+        (DELETE_SWEEP_SECONDS,),
+        fetchall=True,
+    ) or []
+    now = time.time()
+    for chat_id, message_id in rows:
+        _push_deletion(now, chat_id, message_id)
+    return len(rows)
+
+
+async def _delete_chat_batch(bot, chat_id: int, message_ids: List[int]) -> None:
+    finished: List[int] = []
+    retry: List[int] = []
+    retry_in = DELETE_RETRY_SECONDS
+    for i in range(0, len(message_ids), DELETE_BATCH_MAX):
+        chunk = message_ids[i:i + DELETE_BATCH_MAX]
+        for attempt in range(2):
+            try:
+                if len(chunk) == 1:
+                    await bot.delete_message(chat_id=chat_id, message_id=chunk[0])
+                else:
+                    await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+                finished.extend(chunk)
+                break
+            except RetryAfter as e:
+                if attempt == 0:
+                    await asyncio.sleep(_retry_after_seconds(e))
+                    continue
+                retry.extend(chunk)
+                retry_in = max(retry_in, _retry_after_seconds(e))
+            except (BadRequest, Forbidden):
+                # Already deleted / too old / chat gone: nothing left to do
+                finished.extend(chunk)
+                break
+            except Exception as e:
+                # Network error or timeout: the messages may still be there, try again later
+                logger.warning("Auto-delete for chat %s failed, retrying in %ss: %s", chat_id, retry_in, e)
+                retry.extend(chunk)
+                break
+
+    try:
+        if finished:
+            await _db_exec(
+                "DELETE FROM pending_deletions WHERE chat_id = %s AND message_id = ANY(%s)",
+                (int(chat_id), finished),
+            )
+        if retry:
+            # Move due_at too, so the overdue sweep doesn't pick the rows up again meanwhile
+            await _db_exec(
+                """
+                UPDATE pending_deletions SET due_at = now() + make_interval(secs => %s)
+                WHERE chat_id = %s AND message_id = ANY(%s)
+                """,
+                (retry_in, int(chat_id), retry),
+            )
+    except Exception as e:
+        logger.warning("Could not update pending deletions for chat %s: %s", chat_id, e)
+
+    due = time.time() + retry_in
+    for mid in retry:
+        _push_deletion(due, chat_id, mid)
+
+
+async def _delete_worker(bot) -> None:
+    assert _delete_wakeup is not None
+    next_sweep = time.monotonic() + DELETE_SWEEP_SECONDS
+    while True:
         try:
-            await asyncio.sleep(delay)
-            await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception:
-            return
+            _delete_wakeup.clear()
+            if time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + DELETE_SWEEP_SECONDS
+                await sweep_overdue_deletions()
+            now = time.time()
+            due: Dict[int, List[int]] = {}
+            while _delete_heap and _delete_heap[0][0] <= now:
+                _, chat_id, message_id = heapq.heappop(_delete_heap)
+                due.setdefault(chat_id, []).append(message_id)
+
+            if due:
+                await asyncio.gather(*(_delete_chat_batch(bot, c, mids) for c, mids in due.items()))
+                continue
+
+            timeout = (_delete_heap[0][0] - now) if _delete_heap else DELETE_SWEEP_SECONDS
+            timeout = min(timeout, max(0.0, next_sweep - time.monotonic()))
+            try:
+                await asyncio.wait_for(_delete_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Auto-delete worker error: %s", e)
+            await asyncio.sleep(5)
 
-    asyncio.create_task(_delete())
+
+async def start_delete_worker(bot) -> None:
+    global _delete_wakeup, _delete_task
+    if _delete_task is not None and not _delete_task.done():
+        return
+    _delete_wakeup = asyncio.Event()
+    n = await load_pending_deletions()
+    logger.info("Auto-delete: %s pending deletions loaded.", n)
+    _delete_task = asyncio.create_task(_delete_worker(bot))
+
+
+async def stop_delete_worker() -> None:
+    global _delete_task, _delete_wakeup
+    if _delete_task is None:
+        return
+    _delete_task.cancel()
+    try:
+        await _delete_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    _delete_task = None
+    _delete_wakeup = None
+    _delete_heap.clear()  # rows stay in the DB for the next leader
 
 
 # ---------------------------- UI TEXT ----------------------------
@@ -595,7 +1981,7 @@ ABOUT_TEXT_HTML = (
 
 
 async def send_start_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    photo_id = get_start_photo_id()
+    photo_id = await get_start_photo_id()
     keyboard = InlineKeyboardMarkup(
         [
             [
@@ -617,7 +2003,7 @@ async def send_start_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def send_about_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    photo_id = get_start_photo_id()
+    photo_id = await get_start_photo_id()
     kb = InlineKeyboardMarkup([[InlineKeyboardButton(BTN_CLOSE, callback_data="ui_close")]])
     msg = update.effective_message
     if not msg:
@@ -630,7 +2016,7 @@ async def send_about_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def send_join_required_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, missing, media_id: str):
-    photo_id = get_start_photo_id()
+    photo_id = await get_start_photo_id()
     buttons = []
     for channel_link, _, button_name in missing:
         buttons.append([InlineKeyboardButton(button_name, url=channel_link)])
@@ -650,59 +2036,143 @@ async def send_join_required_screen(update: Update, context: ContextTypes.DEFAUL
 
 # ---------------------------- MEDIA DELIVERY ----------------------------
 
-async def _send_media_for_media_id(update: Update, context: ContextTypes.DEFAULT_TYPE, media_id: str):
+# Telegram albums: 2..10 items; photos/videos can mix, documents only with documents.
+MEDIA_GROUP_MAX = 10
+_ALBUM_KIND = {"photo": "visual", "video": "visual", "document": "document"}
+DELIVERY_FLOOD_RETRIES = 2  # flood waits honoured per album / single send before giving up
+
+
+async def _send_single_file(context: ContextTypes.DEFAULT_TYPE, target_msg: Message, f: Mapping[str, Any]) -> Optional[Message]:
+    t = f.get("type")
+    caption = f.get("caption", "") or ""
+    file_id = f.get("file_id")
+
+    if t == "photo":
+        return await target_msg.reply_photo(file_id, caption=caption)
+    if t == "video":
+        return await target_msg.reply_video(file_id, caption=caption)
+    if t == "document":
+        return await target_msg.reply_document(file_id, caption=caption)
+    if t == "animation":
+        return await target_msg.reply_animation(file_id, caption=caption)
+    if t == "video_note":
+        return await context.bot.send_video_note(target_msg.chat.id, file_id)
+    return None
+
+
+def _input_media(f: Mapping[str, Any]):
+    t = f.get("type")
+    caption = f.get("caption", "") or None
+    if t == "photo":
+        return InputMediaPhoto(f.get("file_id"), caption=caption)
+    if t == "video":
+        return InputMediaVideo(f.get("file_id"), caption=caption)
+    return InputMediaDocument(f.get("file_id"), caption=caption)
+
+
+def _plan_delivery(files: Sequence[Mapping[str, Any]]) -> List[List[Mapping[str, Any]]]:
+    # Split into ordered batches: album-compatible runs (<= 10) and single sends.
+    batches: List[List[Mapping[str, Any]]] = []
+    cur: List[Mapping[str, Any]] = []
+    cur_kind: Optional[str] = None
+    for f in files:
+        kind = _ALBUM_KIND.get(f.get("type"))
+        if kind is None or kind != cur_kind or len(cur) >= MEDIA_GROUP_MAX:
+            if cur:
+                batches.append(cur)
+            cur, cur_kind = [], None
+        if kind is None:
+            batches.append([f])
+            continue
+        cur.append(f)
+        cur_kind = kind
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+async def _deliver_files(
+    context: ContextTypes.DEFAULT_TYPE, target_msg: Message, files: Sequence[Mapping[str, Any]], media_id: str
+) -> List[Message]:
+    sent_messages: List[Message] = []
+    for batch in _plan_delivery(files):
+        if len(batch) > 1:
+            fallback = False
+            for attempt in range(DELIVERY_FLOOD_RETRIES + 1):
+                try:
+                    msgs = await target_msg.reply_media_group(media=[_input_media(f) for f in batch])
+                    sent_messages.extend(msgs)
+                except RetryAfter as e:
+                    # Wait out the flood limit and resend the same album, not its items one by one
+                    if attempt < DELIVERY_FLOOD_RETRIES:
+                        await asyncio.sleep(_retry_after_seconds(e))
+                        continue
+                    logger.warning("Album send for media_id=%s gave up after flood waits: %s", media_id, e)
+                except BadRequest as e:
+                    # e.g. one bad file_id rejects the whole album: retry item by item
+                    logger.warning("Album send failed for media_id=%s (%s items): %s", media_id, len(batch), e)
+                    fallback = True
+                except (TimedOut, NetworkError) as e:
+                    # The album may have arrived anyway; resending risks duplicates
+                    logger.warning("Album send for media_id=%s timed out: %s", media_id, e)
+                except Exception as e:
+                    logger.exception("Album send failed for media_id=%s: %s", media_id, e)
+                break
+            if not fallback:
+                continue
+
+        for f in batch:
+            for attempt in range(DELIVERY_FLOOD_RETRIES + 1):
+                try:
+                    sent_msg = await _send_single_file(context, target_msg, f)
+                    if sent_msg:
+                        sent_messages.append(sent_msg)
+                except RetryAfter as e:
+                    if attempt < DELIVERY_FLOOD_RETRIES:
+                        await asyncio.sleep(_retry_after_seconds(e))
+                        continue
+                    logger.warning("Send for media_id=%s gave up after flood waits: %s", media_id, e)
+                except Exception as e:
+                    logger.exception("Send failed for media_id=%s: %s", media_id, e)
+                break
+    return sent_messages
+
+
+async def _send_media_for_media_id(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    media_id: str,
+    uctx: Optional[UserContext] = None,
+):
     target_msg = update.effective_message
     if not target_msg:
         return
 
-    user_id = update.effective_user.id
+    user = update.effective_user
+    user_id = user.id
+    if uctx is None:
+        uctx = await load_user_context(user_id, user.username)
 
     # Daily limit (premium/admin unlimited)
-    limit = get_daily_limit()
-    if limit > 0 and (not is_premium(user_id)) and (not is_admin(user_id)):
-        used = count_user_downloads_today(user_id)
-        if used >= limit:
-            await send_plain_text(
-                target_msg,
-                f"Daily limit reached.\n\nLimit: {limit}/day\nUsed today: {used}\n\nContact admin for premium (unlimited).",
-            )
-            return
+    if uctx.limit_reached:
+        await send_plain_text(
+            target_msg,
+            f"Daily limit reached.\n\nLimit: {uctx.daily_limit}/day\nUsed today: {uctx.downloads_today}\n\nContact admin for premium (unlimited).",
+        )
+        return
 
-    files = get_data(media_id)
+    files = await get_data(media_id)
     if not files:
         await send_plain_text(target_msg, "This media is expired or not found.")
         return
 
     # Processing msg can be styled, doesn't matter
-    processing = await send_text(target_msg, "Processing...", protect=True)
+    processing = await send_text(target_msg, "Processing...", protect=True, cache=True)
     await asyncio.sleep(0.6)
 
-    sent_messages: List[Message] = []
-
     # IMPORTANT FIX:
     # Remove protect_content from delivered media so users can share/forward/download.
-    for f in files:
-        try:
-            t = f.get("type")
-            caption = f.get("caption", "") or ""
-            file_id = f.get("file_id")
-
-            sent_msg: Optional[Message] = None
-            if t == "photo":
-                sent_msg = await target_msg.reply_photo(file_id, caption=caption)
-            elif t == "video":
-                sent_msg = await target_msg.reply_video(file_id, caption=caption)
-            elif t == "document":
-                sent_msg = await target_msg.reply_document(file_id, caption=caption)
-            elif t == "animation":
-                sent_msg = await target_msg.reply_animation(file_id, caption=caption)
-            elif t == "video_note":
-                sent_msg = await context.bot.send_video_note(target_msg.chat.id, file_id)
-
-            if sent_msg:
-                sent_messages.append(sent_msg)
-        except Exception as e:
-            logger.exception("Send failed for media_id=%s: %s", media_id, e)
+    sent_messages = await _deliver_files(context, target_msg, files, media_id)
 
     try:
         await processing.delete()
@@ -710,12 +2180,12 @@ async def _send_media_for_media_id(update: Update, context: ContextTypes.DEFAULT
         pass
 
     try:
-        log_download(media_id, user_id)
+        await log_download(media_id, user_id)
     except Exception:
         pass
 
     # After media: join button (normal)
-    delivery_link, _, delivery_btn_name = get_delivery_button()
+    delivery_link, _, delivery_btn_name = await get_delivery_button()
     join_btn = InlineKeyboardMarkup([[InlineKeyboardButton(delivery_btn_name, url=delivery_link)]])
 
     msg2 = await send_plain_text(
@@ -725,16 +2195,15 @@ async def _send_media_for_media_id(update: Update, context: ContextTypes.DEFAULT
     )
 
     if AUTO_DELETE_SECONDS > 0:
-        for m in sent_messages:
-            await schedule_delete_message(context.bot, m.chat.id, m.message_id, AUTO_DELETE_SECONDS)
-        await schedule_delete_message(context.bot, msg2.chat.id, msg2.message_id, AUTO_DELETE_SECONDS)
+        ids = [m.message_id for m in sent_messages] + [msg2.message_id]
+        await schedule_delete_messages(msg2.chat.id, ids, AUTO_DELETE_SECONDS)
 
 
 # ---------------------------- BROADCAST (ADMIN) ----------------------------
 
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
 
     args = context.args
@@ -746,12 +2215,12 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     context.user_data["awaiting_broadcast"] = True
     context.user_data["broadcast_target"] = "all"
-    await send_text(update.effective_message, "Send broadcast content now.", protect=True)
+    await send_text(update.effective_message, "Send broadcast content now.", protect=True, cache=True)
 
 
 async def pbroadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
 
     args = context.args
@@ -763,17 +2232,22 @@ async def pbroadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     context.user_data["awaiting_broadcast"] = True
     context.user_data["broadcast_target"] = "premium"
-    await send_text(update.effective_message, "Send premium broadcast content now.", protect=True)
+    await send_text(update.effective_message, "Send premium broadcast content now.", protect=True, cache=True)
 
 
-async def _capture_broadcast_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _capture_broadcast_content(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    uctx: Optional[UserContext] = None,
+):
     msg = update.effective_message
     if not msg:
         return
 
-    if not is_admin(update.effective_user.id):
+    admin = uctx.admin if uctx is not None else await is_admin(update.effective_user.id)
+    if not admin:
         context.user_data.pop("awaiting_broadcast", None)
-        await send_text(msg, "Admin only.", protect=True)
+        await send_text(msg, "Admin only.", protect=True, cache=True)
         return
 
     target = context.user_data.get("broadcast_target", "all")
@@ -792,7 +2266,7 @@ async def _capture_broadcast_content(update: Update, context: ContextTypes.DEFAU
     elif msg.text:
         payload = {"type": "text", "text": msg.text, "target": target}
     else:
-        await send_text(msg, "Unsupported content.", protect=True)
+        await send_text(msg, "Unsupported content.", protect=True, cache=True)
         return
 
     context.user_data.pop("awaiting_broadcast", None)
@@ -803,7 +2277,7 @@ async def _capture_broadcast_content(update: Update, context: ContextTypes.DEFAU
 async def _send_broadcast_preview(update: Update, context: ContextTypes.DEFAULT_TYPE):
     payload = context.user_data.get("broadcast_pending")
     if not payload:
-        await send_text(update.effective_message, "No broadcast content.", protect=True)
+        await send_text(update.effective_message, "No broadcast content.", protect=True, cache=True)
         return
 
     keyboard = InlineKeyboardMarkup(
@@ -855,80 +2329,507 @@ async def _send_broadcast_preview(update: Update, context: ContextTypes.DEFAULT_
                 **protect_kwargs(),
             )
         else:
-            await send_text(update.effective_message, "Unsupported preview.", protect=True)
+            await send_text(update.effective_message, "Unsupported preview.", protect=True, cache=True)
             return
     except Exception as e:
         logger.exception("Preview send failed: %s", e)
-        await send_text(update.effective_message, "Failed to send preview.", protect=True)
+        await send_text(update.effective_message, "Failed to send preview.", protect=True, cache=True)
         return
 
-    context.user_data["broadcast_preview_message"] = {"chat_id": preview.chat.id, "message_id": preview.message_id}
+    context.user_data["broadcast_preview_message"] = {"chat_id": preview.chat.id, "message_id": preview.message_id}
+
+
+# Telegram allows ~30 msgs/s globally per bot; stay a little under it by default.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25").strip())
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8").strip())
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3").strip())  # network errors
+BROADCAST_MAX_FLOOD_WAITS = int(os.getenv("BROADCAST_MAX_FLOOD_WAITS", "50").strip())
+
+
+class TokenBucket:
+    # Shared rate limiter; pause() blocks every sender (used for RetryAfter).
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = max(0.1, float(rate))
+        self.capacity = max(1.0, float(burst if burst is not None else rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._last = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+# One bucket per process so concurrent broadcasts share the global budget
+_broadcast_bucket: Optional[TokenBucket] = None
+
+
+def get_broadcast_bucket() -> TokenBucket:
+    global _broadcast_bucket
+    if _broadcast_bucket is None:
+        _broadcast_bucket = TokenBucket(BROADCAST_RATE)
+    return _broadcast_bucket
+
+
+async def _send_broadcast_payload(bot, uid: int, payload: Dict[str, Any]) -> None:
+    if payload["type"] == "text":
+        await bot.send_message(uid, payload["text"], **protect_kwargs())
+    elif payload["type"] == "photo":
+        await bot.send_photo(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
+    elif payload["type"] == "video":
+        await bot.send_video(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
+    elif payload["type"] == "video_note":
+        await bot.send_video_note(uid, payload["file_id"], **protect_kwargs())
+    elif payload["type"] == "document":
+        await bot.send_document(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
+    elif payload["type"] == "animation":
+        await bot.send_animation(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
+    else:
+        await bot.send_message(uid, "Message from admin", **protect_kwargs())
+
+
+async def _broadcast_one(bot, uid: int, payload: Dict[str, Any], bucket: TokenBucket) -> str:
+    # Returns the outcome key: sent / blocked / invalid / failed.
+    # Flood waits have their own (large) budget so they delay a user, not drop them.
+    errors = 0
+    floods = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await _send_broadcast_payload(bot, uid, payload)
+            return "sent"
+        except RetryAfter as e:
+            floods += 1
+            if floods > BROADCAST_MAX_FLOOD_WAITS:
+                return "failed"
+            wait = _retry_after_seconds(e)
+            logger.warning("Broadcast flood wait: pausing %.1fs", wait)
+            bucket.pause(wait + 0.5)
+        except Forbidden:
+            return "blocked"
+        except BadRequest:
+            return "invalid"
+        except (TimedOut, NetworkError):
+            if errors >= BROADCAST_MAX_RETRIES:
+                return "failed"
+            errors += 1
+            await asyncio.sleep(1.0 * errors)
+        except Exception:
+            return "failed"
+
+
+def _broadcast_summary(counts: Dict[str, int]) -> str:
+    return (
+        f"✅ {counts['sent']} | 🚫 {counts['blocked']} blocked | "
+        f"⚠️ {counts['invalid']} invalid | ❌ {counts['failed']} failed"
+    )
+
+
+# ---------------------------- BROADCAST JOBS ----------------------------
+
+# Jobs live in broadcast_jobs. The runner streams users.user_id (keyset cursor) in pages and
+# checkpoints cursor + counters after each page, so a restart resumes where it stopped.
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "200").strip())
+
+BROADCAST_ACTIVE_STATUSES = ("running", "paused")
+BROADCAST_RESTART_DELAY = 30.0  # backoff before restarting a crashed runner
+
+_broadcast_runners: Dict[int, asyncio.Task] = {}
+
+
+def _audience_where(target: str) -> str:
+    return "banned = 0 AND premium = 1" if target == "premium" else "banned = 0"
+
+
+async def count_broadcast_audience(target: str) -> int:
+    row = await _db_exec(f"SELECT COUNT(*) FROM users WHERE {_audience_where(target)}", fetchone=True)
+    return int(row[0]) if row else 0
+
+
+async def iter_audience(target: str, after_user_id: int = 0, batch_size: int = 500) -> AsyncIterator[List[int]]:
+    # Keyset pages over the partial audience index: each page is a short indexed query, the
+    # first one returns immediately and no pool connection is held between pages.
+    last = int(after_user_id)
+    while True:
+        rows = await _db_exec(
+            f"""
+            SELECT user_id FROM users
+            WHERE {_audience_where(target)} AND user_id > %s
+            ORDER BY user_id
+            LIMIT %s
+            """,
+            (last, int(batch_size)),
+            fetchall=True,
+        ) or []
+        if not rows:
+            return
+        page = [int(r[0]) for r in rows]
+        last = page[-1]
+        yield page
+        if len(page) < batch_size:
+            return
+
+
+async def create_broadcast_job(payload: Dict[str, Any], created_by: int, progress_msg: Optional[Message]) -> int:
+    target = payload.get("target", "all")
+    total = await count_broadcast_audience(target)
+    row = await _db_exec(
+        """
+        INSERT INTO broadcast_jobs (created_by, payload, target, total, progress_chat_id, progress_message_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+        """,
+        (
+            int(created_by),
+            json.dumps(payload, ensure_ascii=False),
+            target,
+            total,
+            progress_msg.chat.id if progress_msg else None,
+            progress_msg.message_id if progress_msg else None,
+        ),
+        fetchone=True,
+    )
+    return int(row[0])
+
+
+async def get_broadcast_job(job_id: int) -> Optional[Dict[str, Any]]:
+    row = await _db_exec(
+        """
+        SELECT id, payload, target, status, cursor_user_id, total, sent, blocked, invalid, failed,
+               progress_chat_id, progress_message_id
+        FROM broadcast_jobs WHERE id = %s
+        """,
+        (int(job_id),),
+        fetchone=True,
+    )
+    if not row:
+        return None
+    keys = (
+        "id", "payload", "target", "status", "cursor", "total", "sent", "blocked", "invalid", "failed",
+        "progress_chat_id", "progress_message_id",
+    )
+    job = dict(zip(keys, row))
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+
+async def list_broadcast_jobs(limit: int = 10) -> List[Tuple[int, str, str, int, int, int]]:
+    rows = await _db_exec(
+        """
+        SELECT id, status, target, total, sent + blocked + invalid + failed, sent
+        FROM broadcast_jobs ORDER BY id DESC LIMIT %s
+        """,
+        (int(limit),),
+        fetchall=True,
+    ) or []
+    return [(int(r[0]), r[1], r[2], int(r[3]), int(r[4]), int(r[5])) for r in rows]
+
+
+async def get_broadcast_status(job_id: int) -> Optional[str]:
+    row = await _db_exec("SELECT status FROM broadcast_jobs WHERE id = %s", (int(job_id),), fetchone=True)
+    return row[0] if row else None
+
+
+async def set_broadcast_status(job_id: int, status: str, only_from: Tuple[str, ...] = ()) -> bool:
+    if only_from:
+        row = await _db_exec(
+            """
+            UPDATE broadcast_jobs SET status = %s, updated_at = now()
+            WHERE id = %s AND status = ANY(%s)
+            RETURNING id
+            """,
+            (status, int(job_id), list(only_from)),
+            fetchone=True,
+        )
+    else:
+        row = await _db_exec(
+            "UPDATE broadcast_jobs SET status = %s, updated_at = now() WHERE id = %s RETURNING id",
+            (status, int(job_id)),
+            fetchone=True,
+        )
+    return bool(row)
+
 
+async def _checkpoint_broadcast(job_id: int, cursor: int, counts: Dict[str, int]) -> None:
+    await _db_exec(
+        """
+        UPDATE broadcast_jobs
+        SET cursor_user_id = %s, sent = %s, blocked = %s, invalid = %s, failed = %s, updated_at = now()
+        WHERE id = %s
+        """,
+        (int(cursor), counts["sent"], counts["blocked"], counts["invalid"], counts["failed"], int(job_id)),
+    )
 
-async def _run_broadcast_task(bot, payload: Dict[str, Any], progress_msg: Optional[Message]):
-    target = payload.get("target", "all")
-    users = get_premium_user_ids() if target == "premium" else get_nonbanned_user_ids()
 
-    total = len(users)
-    sent = 0
-    failed = 0
+async def _run_broadcast_task(bot, job_id: int):
+    job = await get_broadcast_job(job_id)
+    if not job or job["status"] != "running":
+        return
 
-    async def update_progress(done: int):
-        if not progress_msg:
+    payload = job["payload"]
+    target = job["target"]
+    total = job["total"]
+    cursor = int(job["cursor"])
+    counts: Dict[str, int] = {k: int(job[k]) for k in ("sent", "blocked", "invalid", "failed")}
+    done = sum(counts.values())
+    chat_id, message_id = job["progress_chat_id"], job["progress_message_id"]
+    bucket = get_broadcast_bucket()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 4)
+    started = time.monotonic()
+    started_done = done
+
+    async def edit_progress(text: str):
+        if not (chat_id and message_id):
             return
         try:
-            await bot.edit_message_text(
-                apply_font(f"Broadcasting...\nSent: {done}/{total}\n✅ {sent} | ❌ {failed}"),
-                progress_msg.chat.id,
-                progress_msg.message_id,
-            )
+            await bot.edit_message_text(apply_font(text), chat_id, message_id)
         except Exception:
             pass
 
-    for idx, uid in enumerate(users, start=1):
-        try:
-            if payload["type"] == "text":
-                await bot.send_message(uid, payload["text"], **protect_kwargs())
-            elif payload["type"] == "photo":
-                await bot.send_photo(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
-            elif payload["type"] == "video":
-                await bot.send_video(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
-            elif payload["type"] == "video_note":
-                await bot.send_video_note(uid, payload["file_id"], **protect_kwargs())
-            elif payload["type"] == "document":
-                await bot.send_document(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
-            elif payload["type"] == "animation":
-                await bot.send_animation(uid, payload["file_id"], caption=payload.get("caption", ""), **protect_kwargs())
+    async def sender():
+        nonlocal done
+        while True:
+            uid = await queue.get()
+            try:
+                outcome = await _broadcast_one(bot, uid, payload, bucket)
+                counts[outcome] += 1
+                done += 1
+            finally:
+                queue.task_done()
+
+    async def reporter():
+        # Time-based progress edits (edits count against the rate limit too)
+        while True:
+            await asyncio.sleep(5)
+            await edit_progress(f"Broadcasting #{job_id}...\nSent: {done}/{total}\n{_broadcast_summary(counts)}")
+
+    workers = [asyncio.create_task(sender()) for _ in range(max(1, BROADCAST_CONCURRENCY))]
+    progress_task = asyncio.create_task(reporter())
+    status = "running"
+    try:
+        async with aclosing(iter_audience(target, cursor, BROADCAST_CHECKPOINT_EVERY)) as pages:
+            async for page in pages:
+                # Control point: pause/cancel (possibly from another instance) take effect between pages
+                status = await get_broadcast_status(job_id) or "cancelled"
+                if status != "running":
+                    break
+                # Fencing: if our duty lock is gone, another process may already be running this job
+                if not await still_leading("broadcasts"):
+                    status = "handed over"
+                    break
+                for uid in page:
+                    await queue.put(uid)
+                await queue.join()
+                if not await still_leading("broadcasts"):
+                    status = "handed over"  # leave the checkpoint to the new leader
+                    break
+                cursor = page[-1]
+                await _checkpoint_broadcast(job_id, cursor, counts)
             else:
-                await bot.send_message(uid, "Message from admin", **protect_kwargs())
-            sent += 1
-        except Exception:
-            failed += 1
+                status = await get_broadcast_status(job_id) or "cancelled"
+                if status == "running" and await set_broadcast_status(job_id, "done", only_from=("running",)):
+                    status = "done"
+    finally:
+        progress_task.cancel()
+        for w in workers:
+            w.cancel()
+
+    elapsed = max(0.001, time.monotonic() - started)
+    logger.info(
+        "Broadcast #%s %s: %s/%s (%.1f msg/s) %s",
+        job_id, status, done, total, (done - started_done) / elapsed, counts,
+    )
 
-        if idx % 10 == 0 or idx == total:
-            await update_progress(idx)
+    if status == "handed over":
+        return status  # the new leader owns the progress message now
+    label = {"done": "Done.", "paused": "Paused.", "cancelled": "Cancelled."}.get(status, status)
+    await edit_progress(f"{label} (#{job_id})\nTotal: {total}\n{_broadcast_summary(counts)}")
+    return status
 
-        await asyncio.sleep(0.03)
 
-    if progress_msg:
-        try:
-            await bot.edit_message_text(
-                apply_font(f"Done.\nTotal: {total}\n✅ {sent} | ❌ {failed}"),
-                progress_msg.chat.id,
-                progress_msg.message_id,
-            )
-        except Exception:
-            pass
+def start_broadcast_runner(bot, job_id: int) -> None:
+    task = _broadcast_runners.get(job_id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.create_task(_run_broadcast_task(bot, job_id))
+    _broadcast_runners[job_id] = task
+
+    def _done(t: asyncio.Task) -> None:
+        if _broadcast_runners.get(job_id) is t:
+            _broadcast_runners.pop(job_id, None)
+        if t.cancelled():
+            return
+        err = t.exception()
+        if err is not None:
+            # Job is still 'running' in the DB: pick it up again from its last checkpoint
+            logger.error("Broadcast #%s runner crashed; restarting in %ss", job_id, BROADCAST_RESTART_DELAY,
+                         exc_info=err)
+            asyncio.create_task(_restart_if_running(bot, job_id, BROADCAST_RESTART_DELAY))
+        elif t.result() == "paused":
+            # A /bcresume while this runner was winding down found it still registered and did nothing
+            asyncio.create_task(_restart_if_running(bot, job_id))
+
+    task.add_done_callback(_done)
+
+
+async def _restart_if_running(bot, job_id: int, delay: float = 0.0) -> None:
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if _broadcast_bot is None:
+        return  # broadcast duty moved elsewhere; the new owner resumes the job
+    try:
+        if await get_broadcast_status(job_id) == "running":
+            start_broadcast_runner(bot, job_id)
+    except Exception as e:
+        logger.warning("Broadcast #%s restart check failed, retrying in %ss: %s", job_id, BROADCAST_RESTART_DELAY, e)
+        asyncio.create_task(_restart_if_running(bot, job_id, BROADCAST_RESTART_DELAY))
+
+
+async def resume_broadcast_jobs(bot) -> int:
+    rows = await _db_exec("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id", fetchall=True) or []
+    for (job_id,) in rows:
+        start_broadcast_runner(bot, int(job_id))
+    return len(rows)
+
+
+# Set while this process runs the broadcast duty; otherwise jobs are handed over via NOTIFY.
+_broadcast_bot = None
+
+
+async def start_broadcast_duty(bot) -> None:
+    global _broadcast_bot
+    _broadcast_bot = bot
+    resumed = await resume_broadcast_jobs(bot)
+    if resumed:
+        logger.info("Resumed %s broadcast job(s).", resumed)
+
+
+async def stop_broadcast_duty() -> None:
+    global _broadcast_bot
+    _broadcast_bot = None
+    tasks = list(_broadcast_runners.values())
+    for t in tasks:
+        t.cancel()
+    # Jobs stay 'running' in the DB and resume from their last checkpoint on the next leader
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def kick_broadcast_runner(bot, job_id: int) -> None:
+    if _broadcast_bot is not None:
+        start_broadcast_runner(bot, job_id)
+        return
+    await _db_exec("SELECT pg_notify(%s, 'broadcasts:')", (CACHE_NOTIFY_CHANNEL,), fetchone=True)
+
+
+async def _on_broadcast_notify(_detail: str = "") -> None:
+    if _broadcast_bot is not None:
+        await resume_broadcast_jobs(_broadcast_bot)
+
+
+register_cache_topic("broadcasts", _on_broadcast_notify, _on_broadcast_notify)
+
+
+async def _broadcast_job_arg(update: Update, context: ContextTypes.DEFAULT_TYPE, usage: str) -> Optional[int]:
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
+        return None
+    if not context.args:
+        await send_text(update.effective_message, usage, protect=True, cache=True)
+        return None
+    try:
+        return int(context.args[0].lstrip("#"))
+    except Exception:
+        await send_text(update.effective_message, "Invalid job id.", protect=True, cache=True)
+        return None
+
+
+async def cmd_bcstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
+        return
+
+    if not context.args:
+        jobs = await list_broadcast_jobs()
+        if not jobs:
+            await send_plain_text(update.effective_message, "No broadcast jobs.")
+            return
+        lines = ["Broadcast jobs:"]
+        for job_id, status, target, total, done, sent in jobs:
+            lines.append(f"#{job_id}  {status}  {target}  {done}/{total}  (✅ {sent})")
+        await send_plain_text(update.effective_message, "\n".join(lines))
+        return
+
+    try:
+        job = await get_broadcast_job(int(context.args[0].lstrip("#")))
+    except ValueError:
+        job = None
+    if not job:
+        await send_text(update.effective_message, "Job not found.", protect=True, cache=True)
+        return
+    counts = {k: job[k] for k in ("sent", "blocked", "invalid", "failed")}
+    done = sum(counts.values())
+    await send_plain_text(
+        update.effective_message,
+        f"Broadcast #{job['id']}\n"
+        f"Status: {job['status']}\n"
+        f"Target: {job['target']}\n"
+        f"Progress: {done}/{job['total']} (cursor {job['cursor']})\n"
+        f"{_broadcast_summary(counts)}",
+    )
+
+
+async def cmd_bcpause(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job_id = await _broadcast_job_arg(update, context, "Usage: /bcpause <job_id>")
+    if job_id is None:
+        return
+    ok = await set_broadcast_status(job_id, "paused", only_from=("running",))
+    await send_text(update.effective_message, f"Pausing #{job_id}." if ok else "Job is not running.", protect=True)
+
+
+async def cmd_bcresume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job_id = await _broadcast_job_arg(update, context, "Usage: /bcresume <job_id>")
+    if job_id is None:
+        return
+    ok = await set_broadcast_status(job_id, "running", only_from=("paused",))
+    if not ok:
+        await send_text(update.effective_message, "Job is not paused.", protect=True, cache=True)
+        return
+    await kick_broadcast_runner(context.bot, job_id)
+    await send_text(update.effective_message, f"Resumed #{job_id}.", protect=True)
+
+
+async def cmd_bccancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job_id = await _broadcast_job_arg(update, context, "Usage: /bccancel <job_id>")
+    if job_id is None:
+        return
+    ok = await set_broadcast_status(job_id, "cancelled", only_from=BROADCAST_ACTIVE_STATUSES)
+    await send_text(update.effective_message, f"Cancelled #{job_id}." if ok else "Job is not active.", protect=True)
 
 
 # ---------------------------- COMMANDS ----------------------------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    ensure_user_record(user.id, user.username)
+    uctx = await load_user_context(user.id, user.username)
 
-    if is_banned(user.id):
-        await send_text(update.effective_message, "You are banned.", protect=True)
+    if uctx.banned:
+        await send_text(update.effective_message, "You are banned.", protect=True, cache=True)
         return
 
     media_id = context.args[0] if context.args else ""
@@ -938,7 +2839,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not ok:
             await send_join_required_screen(update, context, missing, media_id)
             return
-        await _send_media_for_media_id(update, context, media_id)
+        await _send_media_for_media_id(update, context, media_id, uctx)
         return
 
     if not ok:
@@ -954,10 +2855,10 @@ async def cmd_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    ensure_user_record(u.id, u.username)
-    prem = "YES" if is_premium(u.id) else "NO"
-    ban = "YES" if is_banned(u.id) else "NO"
-    adm = "YES" if is_admin(u.id) else "NO"
+    uctx = await load_user_context(u.id, u.username)
+    prem = "YES" if uctx.premium else "NO"
+    ban = "YES" if uctx.banned else "NO"
+    adm = "YES" if uctx.admin else "NO"
 
     text = (
         "Profile\n\n"
@@ -973,11 +2874,11 @@ async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # /getfont (ADMIN ONLY + COPY FIX)
 async def cmd_getfont(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /getfont <text>", protect=True)
+        await send_text(update.effective_message, "Usage: /getfont <text>", protect=True, cache=True)
         return
 
     raw = " ".join(context.args)
@@ -991,14 +2892,15 @@ async def cmd_givefont(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # /setfont (ADMIN ONLY)
 async def cmd_setfont(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if not context.args:
         await send_text(
             update.effective_message,
             "Usage: /setfont <style>\n\nAvailable styles: normal, smallcaps, bold, italic, mono",
             protect=True,
+            cache=True,
         )
         return
 
@@ -1008,38 +2910,49 @@ async def cmd_setfont(update: Update, context: ContextTypes.DEFAULT_TYPE):
             update.effective_message,
             "Invalid style.\nAvailable styles: normal, smallcaps, bold, italic, mono",
             protect=True,
+            cache=True,
         )
         return
 
-    set_setting("font_style", style)
-    load_font_from_db()
+    await set_setting("font_style", style)
+    await load_font_from_db()
     await send_text(update.effective_message, f"Font style updated to: {style}", protect=True)
 
 
 # /dset (ADMIN ONLY): delivery join button after media
 async def cmd_dset(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if len(context.args) < 3:
-        await send_text(update.effective_message, "Usage: /dset <channel_link> <chat_id> <button_name>", protect=True)
+        await send_text(
+            update.effective_message,
+            "Usage: /dset <channel_link> <chat_id> <button_name>",
+            protect=True,
+            cache=True,
+        )
         return
 
     channel_link = context.args[0].strip()
     chat_id = context.args[1].strip()
     button_name = " ".join(context.args[2:]).strip()
 
-    set_setting("delivery_channel_link", channel_link)
-    set_setting("delivery_chat_id", chat_id)
-    set_setting("delivery_button_name", button_name)
+    await set_setting("delivery_channel_link", channel_link)
+    await set_setting("delivery_chat_id", chat_id)
+    await set_setting("delivery_button_name", button_name)
 
-    await send_text(update.effective_message, "Delivery join button updated.", protect=True)
+    await send_text(update.effective_message, "Delivery join button updated.", protect=True, cache=True)
 
 
 # /getid
 async def cmd_getid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["awaiting_getid"] = True
-    await send_text(update.effective_message, "Send any photo/video/document.\nI will reply with file_id.", protect=True)
+    await send_text(
+        update.effective_message,
+        "Send any photo/video/document.\nI will reply with file_id.",
+        protect=True,
+        cache=True,
+    )
 
 
 async def _handle_getid_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -1069,77 +2982,102 @@ async def _handle_getid_mode(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await send_plain_text(msg, f"Video note file_id:\n\n{msg.video_note.file_id}")
         return True
 
-    await send_text(msg, "Supported: photo / video / document / animation / video_note", protect=True)
+    await send_text(msg, "Supported: photo / video / document / animation / video_note", protect=True, cache=True)
     return True
 
 
 # ---------------------------- DAILY LIMIT COMMANDS ----------------------------
 
 async def cmd_setlimit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /setlimit <number>", protect=True)
+        await send_text(update.effective_message, "Usage: /setlimit <number>", protect=True, cache=True)
         return
     try:
         n = int(context.args[0])
         if n < 0:
             n = 0
     except Exception:
-        await send_text(update.effective_message, "Invalid number.", protect=True)
+        await send_text(update.effective_message, "Invalid number.", protect=True, cache=True)
         return
 
-    set_daily_limit(n)
+    await set_daily_limit(n)
     if n == 0:
-        await send_text(update.effective_message, "Daily limit disabled.", protect=True)
+        await send_text(update.effective_message, "Daily limit disabled.", protect=True, cache=True)
     else:
         await send_text(update.effective_message, f"Daily limit set to {n}/day (premium/admin unlimited).", protect=True)
 
 
+async def cmd_rebuildusage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
+        return
+    days = 0
+    if context.args:
+        try:
+            days = max(0, int(context.args[0]))
+        except Exception:
+            await send_text(update.effective_message, "Usage: /rebuildusage [days]", protect=True, cache=True)
+            return
+    n = await rebuild_daily_usage(days)
+    await send_text(update.effective_message, f"Daily usage counters rebuilt: {n} rows.", protect=True)
+
+
 async def cmd_removelimit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
-    remove_daily_limit()
-    await send_text(update.effective_message, "Daily limit removed (disabled).", protect=True)
+    await remove_daily_limit()
+    await send_text(update.effective_message, "Daily limit removed (disabled).", protect=True, cache=True)
 
 
 # ---------------------------- FORCE JOIN COMMANDS ----------------------------
 
 async def cmd_set_force(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if len(context.args) < 3:
-        await send_text(update.effective_message, "Usage: /set <channel_link> <chat_id> <button_name>", protect=True)
+        await send_text(
+            update.effective_message,
+            "Usage: /set <channel_link> <chat_id> <button_name>",
+            protect=True,
+            cache=True,
+        )
         return
     channel_link = context.args[0]
     chat_id = context.args[1]
     button_name = " ".join(context.args[2:]).strip()
-    add_force_channel(channel_link, chat_id, button_name)
-    await send_text(update.effective_message, "Force-join channel added.", protect=True)
+    await add_force_channel(channel_link, chat_id, button_name)
+    await send_text(update.effective_message, "Force-join channel added.", protect=True, cache=True)
 
 
 async def cmd_remove_force(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if len(context.args) < 3:
-        await send_text(update.effective_message, "Usage: /remove <channel_link> <chat_id> <button_name>", protect=True)
+        await send_text(
+            update.effective_message,
+            "Usage: /remove <channel_link> <chat_id> <button_name>",
+            protect=True,
+            cache=True,
+        )
         return
     channel_link = context.args[0]
     chat_id = context.args[1]
     button_name = " ".join(context.args[2:]).strip()
-    remove_force_channel(channel_link, chat_id, button_name)
-    await send_text(update.effective_message, "Removed (if exact match existed).", protect=True)
+    await remove_force_channel(channel_link, chat_id, button_name)
+    await send_text(update.effective_message, "Removed (if exact match existed).", protect=True, cache=True)
 
 
 async def cmd_listchannels(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
-    rows = get_force_channels()
+    rows = await get_force_channels()
     if not rows:
         await send_plain_text(update.effective_message, "No force-join channels.")
         return
@@ -1155,21 +3093,21 @@ async def cmd_listchannels(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ---------------------------- SET START PHOTO ----------------------------
 
 async def cmd_setphoto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /setphoto <file_id>", protect=True)
+        await send_text(update.effective_message, "Usage: /setphoto <file_id>", protect=True, cache=True)
         return
     file_id = context.args[0].strip()
-    set_setting("start_photo_file_id", file_id)
-    await send_text(update.effective_message, "Start/About photo saved.", protect=True)
+    await set_setting("start_photo_file_id", file_id)
+    await send_text(update.effective_message, "Start/About photo saved.", protect=True, cache=True)
 
 
 # ---------------------------- ADMIN MENU ----------------------------
 
 async def cmd_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
 
     text = (
@@ -1180,15 +3118,16 @@ async def cmd_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/setfont <style>\n/getfont <text>\n\n"
         "Admin:\n"
         "/upload\n/stats\n/users\n/broadcast\n/pbroadcast\n"
+        "/bcstatus [job_id]\n/bcpause <job_id>\n/bcresume <job_id>\n/bccancel <job_id>\n"
         "/ban <id>\n/unban <id>\n"
         "/premium <id>\n/unpremium <id>\n/premiumusers\n"
-        "/del <media_id>\n/genlink <media_id>\n/usage <media_id>\n"
+        "/del <media_id>\n/genlink <media_id>\n/usage <media_id>\n/top [today|7d|30d|all]\n"
         "/setphoto <file_id>\n"
         "/set <channel_link> <chat_id> <button_name>\n"
         "/remove <channel_link> <chat_id> <button_name>\n"
         "/listchannels\n"
         "/dset <channel_link> <chat_id> <button_name>\n"
-        "/setlimit <number>\n/removelimit\n\n"
+        "/setlimit <number>\n/removelimit\n/rebuildusage [days]\n\n"
         "Owner:\n"
         "/addadmin <id>\n/removeadmin <id>\n/adminlist\n"
     )
@@ -1196,32 +3135,41 @@ async def cmd_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await send_text(update.effective_message, "Admin only.", protect=True)
+    if not await is_admin(update.effective_user.id):
+        await send_text(update.effective_message, "Admin only.", protect=True, cache=True)
         return
 
-    total = (_db_exec("SELECT COUNT(*) FROM users", fetchone=True) or [0])[0]
-    banned = (_db_exec("SELECT COUNT(*) FROM users WHERE banned = 1", fetchone=True) or [0])[0]
-    premium = (_db_exec("SELECT COUNT(*) FROM users WHERE premium = 1", fetchone=True) or [0])[0]
-    downloads = (_db_exec("SELECT COUNT(*) FROM downloads", fetchone=True) or [0])[0]
-    limit = get_daily_limit()
+    c = await get_bot_counters()
+    limit = await get_daily_limit()
+    ms = membership_stats
+    mc = media_cache_stats
+    mc_lookups = mc["hits"] + mc["neg_hits"] + mc["misses"]
+    mc_rate = 100.0 * (mc["hits"] + mc["neg_hits"]) / mc_lookups if mc_lookups else 0.0
 
     # COPY FIX: plain
     await send_plain_text(
         update.effective_message,
         "Bot Stats\n"
-        f"Users: {total}\n"
-        f"Premium: {premium}\n"
-        f"Banned: {banned}\n"
-        f"Downloads: {downloads}\n"
-        f"Daily limit: {limit if limit > 0 else 'OFF'}",
+        f"Users: {c['users']}\n"
+        f"Premium: {c['premium']}\n"
+        f"Banned: {c['banned']}\n"
+        f"Downloads: {c['downloads']}\n"
+        f"Downloads today: {c['downloads_today']}\n"
+        f"Active downloaders (7d): {c['active_7d']}\n"
+        f"Daily limit: {limit if limit > 0 else 'OFF'}\n\n"
+        f"Join cache: {ms['hits']} hits ({ms['neg_hits']} negative) | {ms['misses']} misses | "
+        f"{ms['bypassed']} bypassed | {len(_membership_cache)} entries\n"
+        f"User upserts: {user_seen_stats['writes']} written | {user_seen_stats['skipped']} skipped\n"
+        f"Media cache: {mc['hits']} hits | {mc['neg_hits']} negative | {mc['misses']} misses | "
+        f"{mc_rate:.0f}% hit rate | {len(_media_cache)} entries, {_media_cache_bytes // 1024} KB\n"
+        f"{transport_stats_line()}",
     )
 
 
 async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
-    rows = _db_exec(
+    rows = await _db_exec(
         "SELECT user_id, username, premium, banned FROM users ORDER BY user_id DESC LIMIT 50",
         fetchall=True,
     ) or []
@@ -1234,115 +3182,139 @@ async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def make_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /premium <id>", protect=True)
+        await send_text(update.effective_message, "Usage: /premium <id>", protect=True, cache=True)
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await send_text(update.effective_message, "Invalid user id.", protect=True)
+        await send_text(update.effective_message, "Invalid user id.", protect=True, cache=True)
         return
-    set_premium(uid, True)
+    await set_premium(uid, True)
     await send_text(update.effective_message, f"Premium added: {uid}", protect=True)
 
 
 async def remove_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /unpremium <id>", protect=True)
+        await send_text(update.effective_message, "Usage: /unpremium <id>", protect=True, cache=True)
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await send_text(update.effective_message, "Invalid user id.", protect=True)
+        await send_text(update.effective_message, "Invalid user id.", protect=True, cache=True)
         return
-    set_premium(uid, False)
+    await set_premium(uid, False)
     await send_text(update.effective_message, f"Premium removed: {uid}", protect=True)
 
 
 async def cmd_premiumusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
-    rows = _db_exec(
+    rows = await _db_exec(
         "SELECT user_id, username FROM users WHERE premium = 1 AND banned = 0 ORDER BY user_id DESC LIMIT 200",
         fetchall=True,
     ) or []
     if not rows:
-        await send_text(update.effective_message, "No premium users.", protect=True)
+        await send_text(update.effective_message, "No premium users.", protect=True, cache=True)
         return
     text = "Premium users:\n" + "\n".join([f"{uid}  @{uname or 'None'}" for uid, uname in rows])
     await send_plain_text(update.effective_message, text)
 
 
 async def cmd_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /ban <id>", protect=True)
+        await send_text(update.effective_message, "Usage: /ban <id>", protect=True, cache=True)
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await send_text(update.effective_message, "Invalid user id.", protect=True)
+        await send_text(update.effective_message, "Invalid user id.", protect=True, cache=True)
         return
-    ban_user(uid)
+    await ban_user(uid)
     await send_text(update.effective_message, f"Banned: {uid}", protect=True)
 
 
 async def cmd_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /unban <id>", protect=True)
+        await send_text(update.effective_message, "Usage: /unban <id>", protect=True, cache=True)
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await send_text(update.effective_message, "Invalid user id.", protect=True)
+        await send_text(update.effective_message, "Invalid user id.", protect=True, cache=True)
         return
-    unban_user(uid)
+    await unban_user(uid)
     await send_text(update.effective_message, f"Unbanned: {uid}", protect=True)
 
 
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /del <media_id>", protect=True)
+        await send_text(update.effective_message, "Usage: /del <media_id>", protect=True, cache=True)
         return
     media_id = context.args[0]
-    _db_exec("DELETE FROM media_files WHERE media_id = %s", (media_id,), commit=True)
-    await send_text(update.effective_message, "Deleted (if it existed).", protect=True)
+    await delete_media(media_id)
+    await send_text(update.effective_message, "Deleted (if it existed).", protect=True, cache=True)
 
 
 async def cmd_genlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /genlink <media_id>", protect=True)
+        await send_text(update.effective_message, "Usage: /genlink <media_id>", protect=True, cache=True)
         return
     media_id = context.args[0]
-    if not get_data(media_id):
-        await send_text(update.effective_message, "Media not found.", protect=True)
+    if not await get_data(media_id):
+        await send_text(update.effective_message, "Media not found.", protect=True, cache=True)
         return
-    me = await context.bot.get_me()
-    link = f"https://t.me/{me.username}?start={media_id}"
+    link = share_link(media_id)
     # COPY FIX
     await send_plain_text(update.effective_message, f"Media ID: {media_id}\nLink:\n{link}")
 
 
 async def cmd_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /usage <media_id>", protect=True)
+        await send_text(update.effective_message, "Usage: /usage <media_id>", protect=True, cache=True)
         return
     media_id = context.args[0]
-    row = _db_exec("SELECT COUNT(*) FROM downloads WHERE media_id = %s", (media_id,), fetchone=True) or [0]
-    await send_plain_text(update.effective_message, f"Usage ({media_id}): {row[0]}")
+    stats = await get_media_stats(media_id)
+    if not stats:
+        await send_plain_text(update.effective_message, f"Usage ({media_id}): 0")
+        return
+    total, last_at, unique = stats
+    last = last_at.strftime("%Y-%m-%d %H:%M UTC") if last_at else "-"
+    await send_plain_text(
+        update.effective_message,
+        f"Usage ({media_id}): {total}\nUnique users: ~{unique}\nLast download: {last}",
+    )
+
+
+async def cmd_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.id):
+        return
+    period = (context.args[0].strip().lower() if context.args else "7d")
+    if period not in TOP_PERIODS:
+        await send_text(update.effective_message, "Usage: /top [today|7d|30d|all]", protect=True, cache=True)
+        return
+    rows = await get_top_media(period)
+    if not rows:
+        await send_plain_text(update.effective_message, f"No downloads ({period}).")
+        return
+    lines = [f"Top links ({period}):"]
+    for i, (media_id, n) in enumerate(rows, start=1):
+        lines.append(f"{i}. {media_id}  {n}")
+    await send_plain_text(update.effective_message, "\n".join(lines))
 
 
 # ---------------------------- OWNER ----------------------------
@@ -1351,14 +3323,14 @@ async def cmd_addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /addadmin <user_id>", protect=True)
+        await send_text(update.effective_message, "Usage: /addadmin <user_id>", protect=True, cache=True)
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await send_text(update.effective_message, "Invalid id.", protect=True)
+        await send_text(update.effective_message, "Invalid id.", protect=True, cache=True)
         return
-    add_admin_db(uid, update.effective_user.id)
+    await add_admin_db(uid, update.effective_user.id)
     await send_text(update.effective_message, f"Admin added: {uid}", protect=True)
 
 
@@ -1366,24 +3338,24 @@ async def cmd_removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
     if not context.args:
-        await send_text(update.effective_message, "Usage: /removeadmin <user_id>", protect=True)
+        await send_text(update.effective_message, "Usage: /removeadmin <user_id>", protect=True, cache=True)
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await send_text(update.effective_message, "Invalid id.", protect=True)
+        await send_text(update.effective_message, "Invalid id.", protect=True, cache=True)
         return
-    ok = remove_admin_db(uid)
+    ok = await remove_admin_db(uid)
     if ok:
         await send_text(update.effective_message, f"Admin removed: {uid}", protect=True)
     else:
-        await send_text(update.effective_message, "Not found / owner cannot be removed.", protect=True)
+        await send_text(update.effective_message, "Not found / owner cannot be removed.", protect=True, cache=True)
 
 
 async def cmd_adminlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
-    ids = list_admins_all()
+    ids = await list_admins_all()
     lines = ["Admin list:"]
     for i, uid in enumerate(ids, start=1):
         tag = " (OWNER)" if is_owner(uid) else ""
@@ -1399,8 +3371,9 @@ async def upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    if is_banned(user.id):
-        await send_text(msg_obj, "You are banned.", protect=True)
+    uctx = await load_user_context(user.id, user.username)
+    if uctx.banned:
+        await send_text(msg_obj, "You are banned.", protect=True, cache=True)
         return
 
     ok, missing = await check_force_join_for_user(context.bot, user.id)
@@ -1408,14 +3381,14 @@ async def upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_join_required_screen(update, context, missing, "")
         return
 
-    if not (is_admin(user.id) or is_premium(user.id)):
-        await send_text(msg_obj, "Only Admin/Premium users can upload.", protect=True)
+    if not (uctx.admin or uctx.premium):
+        await send_text(msg_obj, "Only Admin/Premium users can upload.", protect=True, cache=True)
         return
 
     context.user_data["upload_files"] = []
     context.user_data["media_id"] = gen_id()
     await msg_obj.reply_text(
-        apply_font("Send files now. When finished, press ✅."),
+        apply_font("Send files now. When finished, press ✅.", cache=True),
         reply_markup=ReplyKeyboardMarkup([["✅"]], resize_keyboard=True),
         **protect_kwargs(),
     )
@@ -1430,15 +3403,15 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    ensure_user_record(user.id, user.username)
+    uctx = await load_user_context(user.id, user.username)
 
     # Broadcast capture mode
     if context.user_data.get("awaiting_broadcast"):
-        await _capture_broadcast_content(update, context)
+        await _capture_broadcast_content(update, context, uctx)
         return
 
-    if is_banned(user.id):
-        await send_text(msg, "You are banned.", protect=True)
+    if uctx.banned:
+        await send_text(msg, "You are banned.", protect=True, cache=True)
         return
 
     ok, missing = await check_force_join_for_user(context.bot, user.id)
@@ -1459,13 +3432,12 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
             return
 
-        save_data(media_id, files)
-        me = await context.bot.get_me()
-        share_link = f"https://t.me/{me.username}?start={media_id}"
+        await save_data(media_id, files)
+        link = share_link(media_id)
 
         # COPY FIX: no font + no protect_content
         await msg.reply_text(
-            f"Uploaded successfully ✅\n\nMedia ID: {media_id}\nLink:\n{share_link}",
+            f"Uploaded successfully ✅\n\nMedia ID: {media_id}\nLink:\n{link}",
             reply_markup=ReplyKeyboardRemove(),
             disable_web_page_preview=True,
         )
@@ -1473,7 +3445,7 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if PRIVATE_CHANNEL_ID is not None:
             try:
                 uname = f"@{user.username}" if user.username else "NoUsername"
-                p_text = f"New Upload\nUser: {uname} ({user.id})\nMedia ID: {media_id}\nLink: {share_link}"
+                p_text = f"New Upload\nUser: {uname} ({user.id})\nMedia ID: {media_id}\nLink: {link}"
                 await context.bot.send_message(PRIVATE_CHANNEL_ID, p_text)
             except Exception:
                 pass
@@ -1485,20 +3457,30 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     f = None
     caption = msg.caption or ""
 
+    src = None
     if msg.photo:
-        f = {"type": "photo", "file_id": msg.photo[-1].file_id, "caption": caption}
+        f = {"type": "photo", "caption": caption}
+        src = msg.photo[-1]
     elif msg.video:
-        f = {"type": "video", "file_id": msg.video.file_id, "caption": caption}
+        f = {"type": "video", "caption": caption}
+        src = msg.video
     elif getattr(msg, "video_note", None):
-        f = {"type": "video_note", "file_id": msg.video_note.file_id, "caption": ""}
+        f = {"type": "video_note", "caption": ""}
+        src = msg.video_note
     elif msg.document:
-        f = {"type": "document", "file_id": msg.document.file_id, "caption": caption}
+        f = {"type": "document", "caption": caption}
+        src = msg.document
     elif msg.animation:
-        f = {"type": "animation", "file_id": msg.animation.file_id, "caption": caption}
+        f = {"type": "animation", "caption": caption}
+        src = msg.animation
+
+    if f is not None:
+        f["file_id"] = src.file_id
+        f["file_unique_id"] = src.file_unique_id
 
     if f and context.user_data.get("media_id"):
         context.user_data.setdefault("upload_files", []).append(f)
-        await send_text(msg, "Saved. Send more or press ✅.", protect=True)
+        await send_text(msg, "Saved. Send more or press ✅.", protect=True, cache=True)
 
 
 # ---------------------------- CALLBACKS ----------------------------
@@ -1528,7 +3510,7 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
 
     if data.startswith("confirm_join:"):
         media_id = data.split(":", 1)[1] if ":" in data else ""
-        ok, missing = await check_force_join_for_user(context.bot, update.effective_user.id)
+        ok, missing = await check_force_join_for_user(context.bot, update.effective_user.id, bypass_negative=True)
 
         if not ok:
             await send_join_required_screen(update, context, missing, media_id or "")
@@ -1554,7 +3536,7 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
     if data.startswith("bc_confirm:") or data.startswith("bc_cancel:"):
         admin_id = int(data.split(":", 1)[1])
         if update.effective_user.id != admin_id:
-            await send_text(query.message, "Only the initiating admin can confirm/cancel.", protect=True)
+            await send_text(query.message, "Only the initiating admin can confirm/cancel.", protect=True, cache=True)
             return
 
         if data.startswith("bc_cancel:"):
@@ -1564,13 +3546,13 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
                 await query.message.edit_reply_markup(reply_markup=None)
             except Exception:
                 pass
-            await send_text(query.message, "Broadcast cancelled.", protect=True)
+            await send_text(query.message, "Broadcast cancelled.", protect=True, cache=True)
             return
 
         payload = context.user_data.get("broadcast_pending")
         info = context.user_data.get("broadcast_preview_message")
         if not payload or not info:
-            await send_text(query.message, "No broadcast payload found.", protect=True)
+            await send_text(query.message, "No broadcast payload found.", protect=True, cache=True)
             return
 
         try:
@@ -1580,14 +3562,17 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
 
         progress_msg = None
         try:
-            progress_msg = await context.bot.send_message(info["chat_id"], apply_font("Broadcasting..."), **protect_kwargs())
+            progress_msg = await context.bot.send_message(
+                info["chat_id"], apply_font("Broadcasting...", cache=True), **protect_kwargs()
+            )
         except Exception:
             pass
 
-        asyncio.create_task(_run_broadcast_task(context.bot, payload, progress_msg))
+        job_id = await create_broadcast_job(payload, admin_id, progress_msg)
+        await kick_broadcast_runner(context.bot, job_id)
         context.user_data.pop("broadcast_pending", None)
         context.user_data.pop("broadcast_preview_message", None)
-        await send_text(query.message, "Broadcast started.", protect=True)
+        await send_text(query.message, f"Broadcast started. Job #{job_id}", protect=True)
         return
 
 
@@ -1598,7 +3583,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     try:
         if isinstance(update, Update) and update.effective_message:
             await update.effective_message.reply_text(
-                apply_font("An error occurred. Please try again."),
+                apply_font("An error occurred. Please try again.", cache=True),
                 **protect_kwargs(),
             )
     except Exception:
@@ -1626,6 +3611,10 @@ async def set_bot_commands(app: Application):
 
         BotCommand("broadcast", "Broadcast (admin)"),
         BotCommand("pbroadcast", "Premium broadcast (admin)"),
+        BotCommand("bcstatus", "Broadcast job status (admin)"),
+        BotCommand("bcpause", "Pause broadcast job (admin)"),
+        BotCommand("bcresume", "Resume broadcast job (admin)"),
+        BotCommand("bccancel", "Cancel broadcast job (admin)"),
 
         BotCommand("ban", "Ban user (admin)"),
         BotCommand("unban", "Unban user (admin)"),
@@ -1643,9 +3632,11 @@ async def set_bot_commands(app: Application):
         BotCommand("del", "Delete media (admin)"),
         BotCommand("genlink", "Generate link (admin)"),
         BotCommand("usage", "Media usage (admin)"),
+        BotCommand("top", "Most downloaded links (admin)"),
 
         BotCommand("setlimit", "Set daily limit (admin)"),
         BotCommand("removelimit", "Remove daily limit (admin)"),
+        BotCommand("rebuildusage", "Rebuild daily usage counters (admin)"),
 
         BotCommand("addadmin", "Add admin (owner)"),
         BotCommand("removeadmin", "Remove admin (owner)"),
@@ -1657,26 +3648,513 @@ async def set_bot_commands(app: Application):
         logger.warning("Could not set bot commands: %s", e)
 
 
-# ---------------------------- MAIN ----------------------------
+# ---------------------------- UPDATE PROCESSING ----------------------------
+
+# Updates from different users run concurrently (up to UPDATE_CONCURRENCY at once);
+# updates from the same user run strictly in arrival order (upload session / broadcast
+# capture in user_data depend on it).
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32").strip())
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", str(UPDATE_CONCURRENCY * 8)).strip())
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency: int, max_pending: int):
+        # The base semaphore only bounds pending updates; running ones are bounded below,
+        # after the per-user lock, so one user's burst can't occupy every slot while queued.
+        super().__init__(max_concurrent_updates=max(max_pending, concurrency))
+        self._run_slots = asyncio.Semaphore(max(1, concurrency))
+        self._user_locks: Dict[int, Tuple[asyncio.Lock, int]] = {}
+
+    @staticmethod
+    def _order_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._order_key(update)
+        if key is None:
+            async with self._run_slots:
+                await coroutine
+            return
+
+        lock, waiters = self._user_locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._user_locks[key] = (lock, waiters + 1)
+        try:
+            async with lock:
+                async with self._run_slots:
+                    await coroutine
+        finally:
+            lock, waiters = self._user_locks[key]
+            if waiters <= 1:
+                del self._user_locks[key]
+            else:
+                self._user_locks[key] = (lock, waiters - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ---------------------------- BOT API TRANSPORT ----------------------------
+
+# Separate HTTP pools: getUpdates long-polling never competes with sends.
+BOT_HTTP_VERSION = os.getenv("BOT_HTTP_VERSION", "1.1").strip()  # "2" needs httpx[http2]
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "10").strip())
+BOT_READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "20").strip())
+BOT_WRITE_TIMEOUT = float(os.getenv("BOT_WRITE_TIMEOUT", "30").strip())
+BOT_POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "10").strip())
+BOT_SEND_POOL_SIZE = int(
+    os.getenv("BOT_SEND_POOL_SIZE", str(UPDATE_CONCURRENCY + BROADCAST_CONCURRENCY + 8)).strip()
+)
+
+
+class MeteredHTTPXRequest(HTTPXRequest):
+    # Gates requests with a semaphore the size of the connection pool, so the time spent
+    # waiting here is exactly the pool wait (httpx itself then never queues).
+    def __init__(self, pool_size: int, **kwargs):
+        super().__init__(connection_pool_size=pool_size, **kwargs)
+        self.pool_size = pool_size
+        self._slots = asyncio.Semaphore(pool_size)
+        self.stats: Dict[str, float] = {"requests": 0, "waited": 0, "wait_total": 0.0, "wait_max": 0.0, "timeouts": 0}
+
+    async def do_request(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=BOT_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise TimedOut("Pool timeout: all connections are busy")
+        wait = time.monotonic() - started
+        st = self.stats
+        st["requests"] += 1
+        st["wait_total"] += wait
+        st["wait_max"] = max(st["wait_max"], wait)
+        if wait > 0.001:
+            st["waited"] += 1
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            self._slots.release()
+
 
-def build_app() -> Application:
-    ensure_schema()
-    ensure_default_force_channel()
-    load_font_from_db()
+_send_request: Optional[MeteredHTTPXRequest] = None
 
-    request = HTTPXRequest(
-        connect_timeout=30.0,
-        read_timeout=60.0,
-        write_timeout=60.0,
-        pool_timeout=60.0,
+
+def build_requests() -> Tuple[MeteredHTTPXRequest, HTTPXRequest]:
+    global _send_request
+    _send_request = MeteredHTTPXRequest(
+        BOT_SEND_POOL_SIZE,
+        connect_timeout=BOT_CONNECT_TIMEOUT,
+        read_timeout=BOT_READ_TIMEOUT,
+        write_timeout=BOT_WRITE_TIMEOUT,
+        pool_timeout=BOT_POOL_TIMEOUT,
+        http_version=BOT_HTTP_VERSION,
+    )
+    # getUpdates adds its long-poll timeout to read_timeout itself
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=1,
+        connect_timeout=BOT_CONNECT_TIMEOUT,
+        read_timeout=BOT_READ_TIMEOUT,
+        write_timeout=BOT_WRITE_TIMEOUT,
+        pool_timeout=BOT_POOL_TIMEOUT,
+        http_version=BOT_HTTP_VERSION,
+    )
+    return _send_request, get_updates_request
+
+
+def transport_stats_line() -> str:
+    if _send_request is None:
+        return "HTTP pool: -"
+    st = _send_request.stats
+    n = int(st["requests"]) or 1
+    return (
+        f"HTTP pool ({_send_request.pool_size}): {int(st['requests'])} req | "
+        f"{int(st['waited'])} waited | avg {1000 * st['wait_total'] / n:.1f} ms | "
+        f"max {1000 * st['wait_max']:.0f} ms | {int(st['timeouts'])} timeouts"
+    )
+
+
+# ---------------------------- LEADERSHIP ----------------------------
+
+# Singleton duties when several processes share the database. Each duty has its own
+# session-level advisory lock, held on a dedicated connection (like LISTEN, it needs a
+# direct/session-mode connection, not a transaction pooler). When the holder dies its
+# session ends, the lock is freed and another process picks the duty up on its next try.
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "10").strip())
+
+
+class Duty(NamedTuple):
+    name: str
+    lock_key: int
+    start: Callable[[], Awaitable[None]]
+    stop: Callable[[], Awaitable[None]]
+
+
+_duties: List[Duty] = []
+_held_duties: Dict[str, Duty] = {}
+_leader_pid: Optional[int] = None
+_leader_task: Optional[asyncio.Task] = None
+
+
+async def _dedicated_connect() -> psycopg.AsyncConnection:
+    # Keepalives so a dead peer is noticed and the session (and its locks) goes away
+    return await psycopg.AsyncConnection.connect(
+        DATABASE_URL, autocommit=True, sslmode="require", prepare_threshold=None,
+        keepalives=1, keepalives_idle=10, keepalives_interval=5, keepalives_count=3,
+    )
+
+
+async def still_leading(duty_name: str) -> bool:
+    # Fencing for long-running duties: our session may have died before the heartbeat
+    # noticed, and another process may already hold the lock.
+    duty = _held_duties.get(duty_name)
+    pid = _leader_pid
+    if duty is None or pid is None:
+        return False
+    row = await _db_exec(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM pg_locks
+            WHERE locktype = 'advisory' AND pid = %s AND granted
+              AND classid::bigint = %s AND objid::bigint = %s AND objsubid = 1
+        )
+        """,
+        (pid, duty.lock_key >> 32, duty.lock_key & 0xFFFFFFFF),
+        fetchone=True,
+    )
+    return bool(row and row[0])
+
+
+async def _release_duties() -> None:
+    for duty in list(_held_duties.values()):
+        try:
+            await duty.stop()
+        except Exception as e:
+            logger.warning("Stopping duty %s failed: %s", duty.name, e)
+        logger.info("Leadership released: %s", duty.name)
+    _held_duties.clear()
+
+
+async def _leader_loop() -> None:
+    global _leader_pid
+    while True:
+        try:
+            async with await _dedicated_connect() as conn:
+                _leader_pid = conn.info.backend_pid
+                while True:
+                    for duty in _duties:
+                        if duty.name in _held_duties:
+                            continue
+                        cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (duty.lock_key,))
+                        if not (await cur.fetchone())[0]:
+                            continue
+                        _held_duties[duty.name] = duty
+                        try:
+                            await duty.start()
+                            logger.info("Leadership acquired: %s", duty.name)
+                        except Exception as e:
+                            logger.exception("Starting duty %s failed: %s", duty.name, e)
+                            _held_duties.pop(duty.name, None)
+                            await conn.execute("SELECT pg_advisory_unlock(%s)", (duty.lock_key,))
+                    await asyncio.sleep(LEADER_RETRY_SECONDS)
+                    # Heartbeat: if the session is gone, so are our locks
+                    await asyncio.wait_for(conn.execute("SELECT 1"), timeout=LEADER_RETRY_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Leader connection lost: %s (retrying in %ss)", e, LEADER_RETRY_SECONDS)
+            _leader_pid = None
+            await _release_duties()
+            await asyncio.sleep(LEADER_RETRY_SECONDS)
+
+
+def start_leadership(bot) -> None:
+    global _leader_task
+
+    async def start_counters() -> None:
+        start_counter_reconciler()
+
+    _duties[:] = [
+        Duty("deletions", 7_431_010, lambda: start_delete_worker(bot), stop_delete_worker),
+        Duty("broadcasts", 7_431_011, lambda: start_broadcast_duty(bot), stop_broadcast_duty),
+        Duty("counters", 7_431_012, start_counters, stop_counter_reconciler),
+    ]
+    if _leader_task is None or _leader_task.done():
+        _leader_task = asyncio.create_task(_leader_loop())
+
+
+async def stop_leadership() -> None:
+    global _leader_task, _leader_pid
+    if _leader_task is not None:
+        _leader_task.cancel()
+        try:
+            await _leader_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _leader_task = None
+    _leader_pid = None
+    # Locks go with the closed connection; duties stop here
+    await _release_duties()
+
+
+# ---------------------------- UPDATE SHARDING ----------------------------
+
+# Scale-out: one "front" process receives updates (polling or webhook) and appends them to
+# update_inbox with shard = user id % UPDATE_SHARDS. "worker" processes (any core, any node)
+# each claim shards with pg_try_advisory_lock(INBOX_LOCK_NS, shard) and consume them in id
+# order. One consumer per shard keeps a user's updates ordered and their user_data sessions
+# (upload, broadcast capture, /getid) in one process; a dead worker's shards are picked up by
+# another worker with free capacity.
+UPDATE_SHARDS = int(os.getenv("UPDATE_SHARDS", "64").strip())  # same value on every process
+WORKER_MAX_SHARDS = int(os.getenv("WORKER_MAX_SHARDS", str(UPDATE_SHARDS)).strip())
+INBOX_LOCK_NS = 7431  # pg_try_advisory_lock(int4, int4) namespace for shard locks
+INBOX_NOTIFY_CHANNEL = "bot_updates"
+INBOX_BATCH = int(os.getenv("INBOX_BATCH", "200").strip())
+INBOX_POLL_SECONDS = float(os.getenv("INBOX_POLL_SECONDS", "1").strip())
+INBOX_QUEUE_MAX = int(os.getenv("INBOX_QUEUE_MAX", "10000").strip())
+
+_inbox_queue: Optional[asyncio.Queue] = None
+_inbox_writer_task: Optional[asyncio.Task] = None
+_inbox_reader_task: Optional[asyncio.Task] = None
+
+
+def update_shard(update: Update) -> int:
+    if update.effective_user is not None:
+        key = update.effective_user.id
+    elif update.effective_chat is not None:
+        key = update.effective_chat.id
+    else:
+        key = 0
+    return abs(int(key)) % UPDATE_SHARDS
+
+
+async def _forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Front handler: the bounded queue pushes back on Telegram when workers fall behind
+    assert _inbox_queue is not None
+    await _inbox_queue.put((update_shard(update), json.dumps(update.to_dict(), ensure_ascii=False)))
+
+
+async def write_inbox(items: List[Tuple[int, str]]) -> None:
+    # One statement per batch; ORDER BY ord keeps ids (and so per-shard order) in arrival order
+    await _db_exec(
+        """
+        WITH ins AS (
+            INSERT INTO update_inbox (shard, payload)
+            SELECT t.shard, t.payload::jsonb
+            FROM unnest(%s::int[], %s::text[]) WITH ORDINALITY AS t(shard, payload, ord)
+            ORDER BY t.ord
+        )
+        SELECT pg_notify(%s, '')
+        """,
+        ([s for s, _ in items], [p for _, p in items], INBOX_NOTIFY_CHANNEL),
+        fetchone=True,
+    )
+
+
+async def _inbox_writer() -> None:
+    assert _inbox_queue is not None
+    while True:
+        items = [await _inbox_queue.get()]
+        while len(items) < INBOX_BATCH and not _inbox_queue.empty():
+            items.append(_inbox_queue.get_nowait())
+        while True:
+            # Updates must not be dropped: retry until the DB takes them (the queue backs up meanwhile)
+            try:
+                await write_inbox(items)
+                break
+            except Exception as e:
+                logger.warning("Inbox write of %s update(s) failed, retrying: %s", len(items), e)
+                await asyncio.sleep(1.0)
+
+
+def start_inbox_writer() -> None:
+    global _inbox_queue, _inbox_writer_task
+    if _inbox_writer_task is None or _inbox_writer_task.done():
+        _inbox_queue = asyncio.Queue(maxsize=INBOX_QUEUE_MAX)
+        _inbox_writer_task = asyncio.create_task(_inbox_writer())
+
+
+async def stop_inbox_writer() -> None:
+    global _inbox_writer_task
+    if _inbox_writer_task is None:
+        return
+    # Flush what the front already accepted
+    while _inbox_queue is not None and not _inbox_queue.empty():
+        await asyncio.sleep(0.1)
+        if _inbox_writer_task.done():
+            break
+    _inbox_writer_task.cancel()
+    try:
+        await _inbox_writer_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    _inbox_writer_task = None
+
+
+async def _claim_shards(conn: psycopg.AsyncConnection, held: set) -> None:
+    want = WORKER_MAX_SHARDS - len(held)
+    if want <= 0:
+        return
+    # LIMIT stops the scan once enough locks are taken, so no extra shards get locked
+    cur = await conn.execute(
+        """
+        SELECT s FROM generate_series(0, %s - 1) AS s
+        WHERE s <> ALL(%s::int[]) AND pg_try_advisory_lock(%s, s)
+        LIMIT %s
+        """,
+        (UPDATE_SHARDS, list(held), INBOX_LOCK_NS, want),
+    )
+    claimed = [int(r[0]) for r in await cur.fetchall()]
+    if claimed:
+        held.update(claimed)
+        logger.info("Claimed %s shard(s), holding %s/%s", len(claimed), len(held), UPDATE_SHARDS)
+
+
+async def _drain_inbox(conn: psycopg.AsyncConnection, held: set, application: Application) -> int:
+    # Read + delete on the lock connection itself: if our session (and locks) died, this fails
+    cur = await conn.execute(
+        """
+        DELETE FROM update_inbox WHERE id IN (
+            SELECT id FROM update_inbox WHERE shard = ANY(%s::int[]) ORDER BY id LIMIT %s
+        )
+        RETURNING id, payload
+        """,
+        (list(held), INBOX_BATCH),
+    )
+    rows = sorted(await cur.fetchall(), key=lambda r: r[0])
+    for _, payload in rows:
+        await application.update_queue.put(Update.de_json(payload, application.bot))
+    return len(rows)
+
+
+async def _inbox_reader(application: Application) -> None:
+    held: set = set()
+    while True:
+        try:
+            async with await _dedicated_connect() as conn:
+                await conn.execute(f"LISTEN {INBOX_NOTIFY_CHANNEL}")
+                held.clear()
+                next_claim = 0.0
+                while True:
+                    if time.monotonic() >= next_claim:
+                        await _claim_shards(conn, held)
+                        next_claim = time.monotonic() + LEADER_RETRY_SECONDS
+                    if held and application.update_queue.qsize() < INBOX_BATCH:
+                        if await _drain_inbox(conn, held, application):
+                            continue
+                    elif held:
+                        await asyncio.sleep(0.05)  # let handlers catch up before taking more
+                        continue
+                    async for _ in conn.notifies(timeout=INBOX_POLL_SECONDS, stop_after=1):
+                        pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Inbox connection lost: %s (releasing %s shard(s), retrying in 5s)", e, len(held))
+            held.clear()
+            await asyncio.sleep(5)
+
+
+def start_inbox_reader(application: Application) -> None:
+    global _inbox_reader_task
+    if _inbox_reader_task is None or _inbox_reader_task.done():
+        _inbox_reader_task = asyncio.create_task(_inbox_reader(application))
+
+
+async def stop_inbox_reader() -> None:
+    global _inbox_reader_task
+    if _inbox_reader_task is None:
+        return
+    _inbox_reader_task.cancel()
+    try:
+        await _inbox_reader_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    _inbox_reader_task = None  # closing the connection releases the shard locks
+
+
+# ---------------------------- WARM-UP ----------------------------
+
+# Filled once at startup (Bot.initialize already fetched getMe), so links need no API call.
+BOT_USERNAME = ""
+
+
+def share_link(media_id: str) -> str:
+    return f"https://t.me/{BOT_USERNAME}?start={media_id}"
+
+
+async def preload_caches() -> None:
+    # Settings, admins and force channels in a single round trip
+    row = await _db_exec(
+        """
+        SELECT
+            (SELECT COALESCE(json_object_agg(key, value), '{}'::json) FROM settings),
+            (SELECT COALESCE(array_agg(user_id), '{}'::bigint[]) FROM admins),
+            (SELECT COALESCE(json_agg(json_build_array(channel_link, chat_id, button_name) ORDER BY id), '[]'::json)
+               FROM force_join_channels WHERE enabled = 1)
+        """,
+        fetchone=True,
+    )
+    settings, admins, channels = row
+    await prime_settings_cache(settings or {})  # also applies the font style
+    prime_admin_cache(admins or [])
+    prime_force_channels(channels or [])
+
+
+async def warm_up(application: Application) -> None:
+    global BOT_USERNAME
+    total = time.monotonic()
+
+    async def step(name: str, coro) -> Any:
+        started = time.monotonic()
+        result = await coro
+        logger.info("Warm-up: %s in %.0f ms", name, 1000 * (time.monotonic() - started))
+        return result
+
+    await step("db pool", init_db_pool())
+    await step("schema", ensure_schema())
+    await step("default force channel", ensure_default_force_channel())
+    await step("settings/admins/channels/font", preload_caches())
+    try:
+        me = application.bot.bot  # fetched by Bot.initialize()
+    except RuntimeError:
+        me = await step("bot identity", application.bot.get_me())
+    BOT_USERNAME = me.username or ""
+    logger.info(
+        "Warm-up done in %.0f ms (@%s, %d settings, %d admins, %d force channels, font=%s)",
+        1000 * (time.monotonic() - total),
+        BOT_USERNAME,
+        len(_settings_cache),
+        len(_admin_ids),
+        len(_force_channels or []),
+        FONT_STYLE,
     )
 
-    app = (
+
+# ---------------------------- MAIN ----------------------------
+
+def build_app(receive_updates: bool = True) -> Application:
+    # receive_updates=False: sharded worker, updates come from update_inbox instead of Telegram
+    request, get_updates_request = build_requests()
+
+    builder = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
         .request(request)
-        .build()
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING))
     )
+    if not receive_updates:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Core
     app.add_handler(CommandHandler("start", start))
@@ -1702,6 +4180,10 @@ def build_app() -> Application:
     # Broadcast
     app.add_handler(CommandHandler("broadcast", broadcast_command))
     app.add_handler(CommandHandler("pbroadcast", pbroadcast_command))
+    app.add_handler(CommandHandler("bcstatus", cmd_bcstatus))
+    app.add_handler(CommandHandler("bcpause", cmd_bcpause))
+    app.add_handler(CommandHandler("bcresume", cmd_bcresume))
+    app.add_handler(CommandHandler("bccancel", cmd_bccancel))
 
     # Others (admin/owner)
     app.add_handler(CommandHandler("setphoto", cmd_setphoto))
@@ -1710,6 +4192,7 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("listchannels", cmd_listchannels))
     app.add_handler(CommandHandler("setlimit", cmd_setlimit))
     app.add_handler(CommandHandler("removelimit", cmd_removelimit))
+    app.add_handler(CommandHandler("rebuildusage", cmd_rebuildusage))
     app.add_handler(CommandHandler("ban", cmd_ban))
     app.add_handler(CommandHandler("unban", cmd_unban))
     app.add_handler(CommandHandler("premium", make_premium))
@@ -1718,6 +4201,7 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("del", cmd_delete))
     app.add_handler(CommandHandler("genlink", cmd_genlink))
     app.add_handler(CommandHandler("usage", cmd_usage))
+    app.add_handler(CommandHandler("top", cmd_top))
     app.add_handler(CommandHandler("addadmin", cmd_addadmin))
     app.add_handler(CommandHandler("removeadmin", cmd_removeadmin))
     app.add_handler(CommandHandler("adminlist", cmd_adminlist))
@@ -1730,17 +4214,164 @@ def build_app() -> Application:
     return app
 
 
-def main() -> None:
+async def _worker_post_init(application: Application) -> None:
+    # DB work needs the running loop (async pool), so it happens here instead of build_app.
+    await warm_up(application)
+    start_cache_listener()
+    start_download_logger()
+    start_leadership(application.bot)
+
+
+async def _worker_post_shutdown(application: Application) -> None:
+    await stop_leadership()
+    await stop_download_logger()
+    await stop_cache_listener()
+    await close_db_pool()
+
+
+def _run_updates(app: Application) -> None:
+    # Receive updates via webhook or long polling (roles "all" and "front")
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL is missing. Set it (public https base URL) for BOT_MODE=webhook.")
+        if not WEBHOOK_SECRET_TOKEN:
+            raise RuntimeError("WEBHOOK_SECRET_TOKEN is missing. Set it for BOT_MODE=webhook.")
+        logger.info("Webhook mode: listening on %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            close_loop=False,
+        )
+        return
+
+    app.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=DROP_PENDING_UPDATES, close_loop=False)
+
+
+def run_all() -> None:
+    # Single process: receive and handle updates here (no inbox)
     app = build_app()
 
     async def _post_init(application: Application):
+        await _worker_post_init(application)
         await set_bot_commands(application)
         logger.info("Bot started.")
 
     app.post_init = _post_init
-    app.run_polling(drop_pending_updates=True, close_loop=False)
+    app.post_shutdown = _worker_post_shutdown
+    _run_updates(app)
+
+
+async def _run_worker_async(max_shards: Optional[int]) -> None:
+    global WORKER_MAX_SHARDS
+    if max_shards is not None:
+        WORKER_MAX_SHARDS = max_shards
+    app = build_app(receive_updates=False)
+    await app.initialize()
+    await _worker_post_init(app)
+    await app.start()
+    start_inbox_reader(app)
+    logger.info("Worker started (pid %s, up to %s of %s shards).", os.getpid(), WORKER_MAX_SHARDS, UPDATE_SHARDS)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await stop_inbox_reader()
+        await app.stop()
+        await _worker_post_shutdown(app)
+        await app.shutdown()
+
+
+def run_worker(max_shards: Optional[int] = None) -> None:
+    asyncio.run(_run_worker_async(max_shards))
+
+
+_worker_procs: List[multiprocessing.process.BaseProcess] = []
+_worker_monitor_task: Optional[asyncio.Task] = None
+
+
+def _spawn_worker(max_shards: int) -> multiprocessing.process.BaseProcess:
+    p = multiprocessing.get_context("spawn").Process(target=run_worker, args=(max_shards,), daemon=True)
+    p.start()
+    return p
+
+
+async def _monitor_workers(max_shards: int) -> None:
+    # Respawn crashed local workers; their shards are free again once their sessions end
+    while True:
+        await asyncio.sleep(5)
+        for i, p in enumerate(_worker_procs):
+            if not p.is_alive():
+                logger.warning("Worker %s (pid %s) exited with %s; respawning.", i, p.pid, p.exitcode)
+                _worker_procs[i] = _spawn_worker(max_shards)
+
+
+def start_local_workers() -> None:
+    global _worker_monitor_task
+    if BOT_WORKERS <= 0:
+        return
+    # Even split; a shard freed by a dying worker waits for its respawn (or a remote worker)
+    max_shards = math.ceil(UPDATE_SHARDS / BOT_WORKERS)
+    _worker_procs[:] = [_spawn_worker(max_shards) for _ in range(BOT_WORKERS)]
+    _worker_monitor_task = asyncio.create_task(_monitor_workers(max_shards))
+    logger.info("Spawned %s local worker(s), %s shard(s) each.", BOT_WORKERS, max_shards)
+
+
+async def stop_local_workers() -> None:
+    global _worker_monitor_task
+    if _worker_monitor_task is not None:
+        _worker_monitor_task.cancel()
+        _worker_monitor_task = None
+    for p in _worker_procs:
+        if p.is_alive():
+            p.terminate()  # SIGTERM: workers finish in-flight updates and shut down cleanly
+    loop = asyncio.get_running_loop()
+    for p in _worker_procs:
+        await loop.run_in_executor(None, p.join, 30)
+    _worker_procs.clear()
+
+
+def run_front() -> None:
+    # Receives updates and shards them into update_inbox; handlers run in the workers
+    request, get_updates_request = build_requests()
+    app = ApplicationBuilder().token(BOT_TOKEN).request(request).get_updates_request(get_updates_request).build()
+    app.add_handler(TypeHandler(Update, _forward_update))
+
+    async def _post_init(application: Application):
+        await init_db_pool()
+        await ensure_schema()
+        start_inbox_writer()
+        start_local_workers()
+        await set_bot_commands(application)
+        logger.info("Front started (%s shards).", UPDATE_SHARDS)
+
+    async def _post_shutdown(application: Application):
+        await stop_inbox_writer()
+        await stop_local_workers()
+        await close_db_pool()
+
+    app.post_init = _post_init
+    app.post_shutdown = _post_shutdown
+    _run_updates(app)
+
+
+def main() -> None:
+    if BOT_ROLE == "front":
+        run_front()
+    elif BOT_ROLE == "worker":
+        run_worker()
+    else:
+        run_all()
 
 
 if __name__ == "__main__":
-    init_db_pool()
     main()